@@ -20,6 +20,10 @@ from Crypto.Cipher import AES
 from Crypto.Util import Padding
 
 from keys import VIEWER_ID_KEY, SID_KEY
+import metrics
+
+API_SECONDS = metrics.histogram("deresute_api_call_seconds", "Upstream API call latency", ("path",))
+API_CALLS = metrics.counter("deresute_api_calls_total", "Upstream API calls by result code", ("path", "result"))
 
 def decrypt_cbc(s, iv, key):
     aes = AES.new(key, AES.MODE_CBC, iv)
@@ -89,15 +93,18 @@ class ApiClient(object):
             "Content-Type": "application/x-www-form-urlencoded", # lies
             "User-Agent": "Dalvik/2.1.0 (Linux; U; Android 8.1.0; Nexus 4 Build/XYZZ1Y)",
         }
+        t = time.time()
         for i in range(3):
             try:
                 req = urllib.request.Request(self.BASE + path, body, headers)
                 reply = urllib.request.urlopen(req).read()
             except urllib.error.URLError as e:
                 if i >= 2:
+                    API_CALLS.inc(path=path, result="error")
                     raise
                 else:
                     continue
+        API_SECONDS.observe(time.time() - t, path=path)
         reply = base64.b64decode(reply)
         plain = decrypt_cbc(reply[:-32], msg_iv, reply[-32:]).split(b"\0")[0]
         msg = msgpack.unpackb(base64.b64decode(plain), strict_map_key=False)
@@ -105,6 +112,7 @@ class ApiClient(object):
             self.sid = msg[b"data_headers"][b"sid"]
         except:
             pass
+        API_CALLS.inc(path=path, result=msg.get(b"data_headers", {}).get(b"result_code", "none"))
         return deep_decode(msg)
 
 if __name__ == "__main__":
@@ -15,81 +15,457 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os.path, os, random, threading, time, json, logging, base64, hashlib, io, struct
+import os.path, os, mimetypes, threading, time, json, logging, base64, hashlib, io, struct, fcntl, cProfile, hmac, heapq, urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import keys
 from keys import BLOB_KEY
 from PIL import Image
 from Crypto.Cipher import AES
 
-import account, render, apiclient, resource_mgr, decode
+import account, render, apiclient, resource_mgr, decode, upstream, negcache, hotcache, storage, janitor, info, export, metrics, tracing, logqueue, shared, popularity, assets, cluster
 from info import ProducerInfo
 
-from flask import Flask, send_file, request, make_response, abort, render_template, redirect
+from flask import Flask, Response, g, has_request_context, send_file, request, make_response, abort, render_template, redirect
 app = Flask(__name__)
 
 if __name__ == "__main__":
     app.config['DEBUG'] = True
 
 BASE = os.path.dirname(os.path.abspath(__file__)) + "/"
-
-CARD_CACHE_DIR = BASE + "data/cards/"
-EMBLEM_CACHE_DIR = BASE + "data/emblems/"
-BANNER_CACHE_DIR = BASE + "data/banners/"
-INFO_CACHE_DIR = BASE + "data/info/"
-SNAPSHOT_DIR = BASE + "data/snap/"
-RESOURCES_DIR = BASE + "data/resources/"
+# Test instances (loadtest.py, replays) point this at a scratch directory
+DATA = os.environ.get("DERESUTE_DATA", BASE + "data/")
+
+CARD_CACHE_DIR = DATA + "cards/"
+EMBLEM_CACHE_DIR = DATA + "emblems/"
+BANNER_CACHE_DIR = DATA + "banners/"
+INFO_CACHE_DIR = DATA + "info/"
+SNAPSHOT_DIR = DATA + "snap/"
+RESOURCES_DIR = DATA + "resources/"
+LOCK_DIR = DATA + "locks/"
+# A fresh DERESUTE_DATA directory may be empty
+os.makedirs(LOCK_DIR, exist_ok=True)
+
+# Banners and icons live in hash-sharded directories, small entries in SQLite.
+# The old flat directories are still read until migrated with storage.py.
+CARD_STORE = storage.FileStorage("cards", DATA + "cards/", legacy_dir=CARD_CACHE_DIR)
+EMBLEM_STORE = storage.FileStorage("emblems", DATA + "emblems/", legacy_dir=EMBLEM_CACHE_DIR)
+BANNER_STORE = storage.FileStorage("banners", DATA + "banners/", legacy_dir=BANNER_CACHE_DIR)
+INFO_STORE = storage.SqliteStorage("info", DATA + "info.db", legacy_dir=INFO_CACHE_DIR)
+SNAPSHOT_STORE = storage.SqliteStorage("snap", DATA + "snap.db", legacy_dir=SNAPSHOT_DIR)
+# Decoded (and resized/converted) /res/ images, keyed by asset hash
+DERIVED_STORE = storage.FileStorage("derived", DATA + "derived/")
+ASSETS_DIR = DATA + "assets/"
+METRICS_DIR = DATA + "metrics/"
+PROFILE_DIR = DATA + "profiles/"
+NEGATIVE_CACHE_FILE = DATA + "negative.bin"
+# Throttle and res_ver state shared by all workers on the host
+SHARED_STATE_FILE = DATA + "shared.json"
+# Access counts used by the janitor to rank cache entries
+HITS_DB = DATA + "hits.db"
+UPSTREAM_LOCK = LOCK_DIR + "upstream"
 
 THROTTLE = 2
+# Operators may lower this, to let the delay drop below THROTTLE when healthy
+MIN_THROTTLE = THROTTLE
+MAX_THROTTLE = 30
+# A backed off delay in the shared state is forgotten after this long without
+# upstream calls (restarts included)
+THROTTLE_EXPIRY = 600
+CIRCUIT_COOLDOWN = 60
 RES_POLL = 600
+# How often workers pick up the res_ver found by whichever one polled last
+RES_SYNC = 10
+JANITOR_INTERVAL = 5
+METRICS_INTERVAL = 10
+BANNER_CACHE_BYTES = 20 * 1024**3
+ICON_CACHE_BYTES = 2 * 1024**3
+DERIVED_CACHE_BYTES = 2 * 1024**3
+NEGATIVE_TTL = 86400
 
 LOG_FILE = BASE + "log/info.log"
+# Fraction of upstream replies written to the log, and how much of each
+PAYLOAD_SAMPLE = 0.05
+MAX_PAYLOAD_LOG = 2048
+# Error mail is batched, at most one per MAIL_INTERVAL seconds per process
+MAIL_INTERVAL = 300
+# One JSON line per request, for replay.py. Off unless set.
+ACCESS_LOG = os.environ.get("DERESUTE_ACCESS_LOG", None)
+LOGGED_BODIES = ("get_batch_json", "get_export")
+LOGGED_BODIES_MAX = 8192
+
+# Cluster mode (see cluster.py): the node list file, and our own URL in it
+CLUSTER_FILE = os.environ.get("DERESUTE_CLUSTER", None)
+CLUSTER_NODE = os.environ.get("DERESUTE_NODE", None)
+CLUSTER_CONNECT_TIMEOUT = 2
+# Owners may queue on the throttle for a while; give up (503) after this
+CLUSTER_TIMEOUT = 120
+CLUSTER_DOWN_TIME = 30
+CLUSTER_HANDOFF = 3600
+# Headers passed on to and back from the owning node
+PROXY_REQUEST_HEADERS = ("If-None-Match", "If-Modified-Since", "Content-Type")
+PROXY_RESPONSE_HEADERS = ("Content-Type", "Cache-Control", "Expires", "ETag", "Last-Modified",
+                          "Content-Disposition", "Location", "Vary")
 
 DEF_MAX_AGE = 300
+# Past DEF_MAX_AGE (but within STALE_MAX_AGE) cached data is still served, and
+# refreshed in the background by one of REFRESH_THREADS workers
+STALE_MAX_AGE = 3600
+STALE_CACHE_TIMEOUT = 30
+# Snapshots are taken from data no older than this
+SNAP_MAX_AGE = 60
+# Snapshots are content-addressed and never change
+SNAPSHOT_CACHE_TIMEOUT = 365 * 86400
+RESOURCE_CACHE_TIMEOUT = 86400
+ASSET_CACHE_TIMEOUT = 365 * 86400
+# /res/ thumbnail widths (?w=) and output formats (?fmt=)
+RES_WIDTHS = (64, 128, 256, 512)
+RES_FORMATS = {"png": "image/png", "webp": "image/webp"}
+REFRESH_THREADS = 2
+BATCH_MAX = 100
+# Batch fetches queue on the throttle, so they get their own pool rather
+# than starving background refreshes
+BATCH_THREADS = 2
+EXPORT_THREADS = 4
+
+# In-memory tier in front of the info, snapshot and banner caches
+HOT_CACHE_BYTES = 256 * 1024 * 1024
+HOT_INFO_SIZE = 4096
+# Most recently used icons of each store preloaded by warmup()
+WARMUP_ICONS = 500
+
+# The POPULAR_TOP most requested producers are refreshed PREFETCH_AHEAD
+# seconds before their data would expire, using otherwise idle upstream time
+POPULAR_TOP = 100
+PREFETCH_AHEAD = 60
+PREFETCH_INTERVAL = 2
 
 g_client = apiclient.ApiClient(account.user_id, account.viewer_id, account.udid)
-g_lock = threading.Lock()
-g_last_fetch = 0
-g_last_check = 0
-g_resmgr = resource_mgr.ResourceManager(g_client.res_ver, RESOURCES_DIR, app.logger)
-
-class RequestFormatter(logging.Formatter):
-    def format(self, record):
-        s = logging.Formatter.format(self, record)
-        try:
-            return '[%s] [%d] [%s] [%s %s] ' % (self.formatTime(record), account.index, request.remote_addr, request.method, request.path) + s
-        except:
-            return '[%s] [%d] [SYS] ' % (self.formatTime(record), account.index) + s
+# Serialises upstream calls across threads and worker processes
+g_lock = shared.HostLock(UPSTREAM_LOCK, threading.Lock())
+g_shared = shared.SharedState(SHARED_STATE_FILE)
+g_upstream = upstream.UpstreamController(app.logger, delay=THROTTLE, min_delay=MIN_THROTTLE,
+                                         max_delay=MAX_THROTTLE, cooldown=CIRCUIT_COOLDOWN)
+g_negative = negcache.NegativeCache(NEGATIVE_CACHE_FILE, app.logger, ttl=NEGATIVE_TTL)
+g_hot = hotcache.HotCache(HOT_CACHE_BYTES)
+g_popular = popularity.Popularity(POPULAR_TOP)
+g_cluster = None
+# Shared by all nodes; requests between them must carry it
+CLUSTER_KEY = getattr(keys, "CLUSTER_KEY", None)
+if CLUSTER_FILE:
+    if not CLUSTER_KEY:
+        raise Exception("Cluster mode needs CLUSTER_KEY in keys.py")
+    g_cluster = cluster.Cluster(CLUSTER_NODE, CLUSTER_FILE, CLUSTER_KEY, app.logger,
+                                connect_timeout=CLUSTER_CONNECT_TIMEOUT, timeout=CLUSTER_TIMEOUT,
+                                down_time=CLUSTER_DOWN_TIME,
+                                handoff=CLUSTER_HANDOFF)
+g_warm = False
+g_warm_lock = threading.Lock()
+g_assets = None
+g_assets_lock = threading.Lock()
+g_janitor = janitor.Janitor(app.logger, LOCK_DIR + "janitor", HITS_DB)
+g_janitor.add_store(INFO_STORE, max_age=STALE_MAX_AGE)
+g_janitor.add_store(BANNER_STORE, max_bytes=BANNER_CACHE_BYTES, max_age=STALE_MAX_AGE)
+g_janitor.add_store(CARD_STORE, max_bytes=ICON_CACHE_BYTES)
+g_janitor.add_store(EMBLEM_STORE, max_bytes=ICON_CACHE_BYTES)
+g_janitor.add_store(DERIVED_STORE, max_bytes=DERIVED_CACHE_BYTES)
+# Snapshots are never evicted, this only cleans up temporary files
+g_janitor.add_store(SNAPSHOT_STORE)
+g_janitor.add_resources(RESOURCES_DIR, lambda: get_resources()[1], lambda: g_shared.get("res_ver"))
+g_janitor.add_locks(LOCK_DIR)
+# (res_ver, ResourceManager) snapshot, only ever replaced as a whole by the poller
+g_resources = (g_client.res_ver, resource_mgr.ResourceManager(g_client.res_ver, RESOURCES_DIR, app.logger))
+g_poller_pid = None
+g_poller_lock = threading.Lock()
+g_poll_event = threading.Event()
+g_flights = {}
+g_flights_lock = threading.Lock()
+g_refresh_pool = None
+g_export_pool = None
+g_batch_pool = None
+g_refresh_pending = set()
+g_refresh_lock = threading.Lock()
+
+CACHE_REQUESTS = metrics.counter("deresute_cache_requests_total", "get_cache lookups by result", ("cache", "result"))
+CACHE_FETCH_SECONDS = metrics.histogram("deresute_cache_fetch_seconds", "Time to produce a missing cache entry", ("cache",))
+THROTTLE_SECONDS = metrics.histogram("deresute_throttle_wait_seconds", "Time spent queueing for the upstream throttle")
+THROTTLE_QUEUE = metrics.gauge("deresute_throttle_queue", "Requests waiting for the upstream throttle")
+RES_VER = metrics.gauge("deresute_res_ver", "Current resource version", mode="max")
+RES_VER_CHANGES = metrics.counter("deresute_res_ver_changes_total", "Resource version updates")
+PREFETCHES = metrics.counter("deresute_prefetch_total", "Proactive refreshes of popular entries", ("kind",))
+
+def request_context():
+    if not has_request_context():
+        return None
+    return {"remote": request.remote_addr, "method": request.method, "path": request.path}
 
 if not app.debug:
     import socket, pwd
-    from logging.handlers import SMTPHandler, WatchedFileHandler
+    from logging.handlers import WatchedFileHandler
     username = pwd.getpwuid(os.getuid()).pw_name
-    mail_handler = SMTPHandler('127.0.0.1',
-                                '%s@%s' % (username, socket.getfqdn()),
-                                'postmaster', 'deresute.me error')
+    mail_handler = logqueue.BatchingSMTPHandler('127.0.0.1',
+                                                '%s@%s' % (username, socket.getfqdn()),
+                                                'postmaster', 'deresute.me error',
+                                                interval=MAIL_INTERVAL)
     mail_handler.setLevel(logging.ERROR)
-    app.logger.addHandler(mail_handler)
 
     handler = WatchedFileHandler(os.path.join(app.root_path, LOG_FILE))
     handler.setLevel(logging.INFO)
-    handler.setFormatter(RequestFormatter())
-    app.logger.addHandler(handler)
+    handler.setFormatter(logqueue.JSONFormatter(account=account.index))
 
+    # Formatting and I/O happen on a listener thread, off the request path
+    app.logger.addHandler(logqueue.QueueHandler([handler, mail_handler], request_context,
+                                                sample=PAYLOAD_SAMPLE, max_payload=MAX_PAYLOAD_LOG))
     app.logger.setLevel(logging.INFO)
     app.logger.warning('Starting...')
 
-def get_cache(cachedir, name, fetch, max_age=None):
-    path = cachedir + name
-    if os.path.exists(path):
-        age = max(0, time.time() - os.stat(path).st_mtime)
+access_logger = logging.getLogger("deresute.access")
+access_logger.propagate = False
+if ACCESS_LOG:
+    from logging.handlers import WatchedFileHandler
+    access_logger.addHandler(logqueue.QueueHandler([WatchedFileHandler(ACCESS_LOG)]))
+    access_logger.setLevel(logging.INFO)
+
+# Requests carrying this key (X-Debug-Profile header or ?profile=) have a
+# cProfile dump written to PROFILE_DIR
+DEBUG_KEY = getattr(keys, "DEBUG_KEY", None)
+
+@app.before_request
+def begin_trace():
+    g.start_time = time.time()
+    tracing.begin()
+    key = request.headers.get("X-Debug-Profile", None) or request.args.get("profile", None)
+    if DEBUG_KEY is not None and key is not None and hmac.compare_digest(
+            key.encode("utf-8"), DEBUG_KEY.encode("utf-8")):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+@app.after_request
+def end_trace(rs):
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profile.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = "%d_%d.prof" % (time.time() * 1000, os.getpid())
+        profile.dump_stats(PROFILE_DIR + name)
+        app.logger.info("Profile of %s written to %s", request.path, name)
+        rs.headers["X-Debug-Profile"] = name
+    spans = tracing.end()
+    if spans:
+        rs.headers["Server-Timing"] = tracing.server_timing(spans)
+    if ACCESS_LOG:
+        log_access(rs, spans)
+    return rs
+
+def log_access(rs, spans):
+    args = request.view_args or {}
+    entry = {
+        "t": round(g.get("start_time", time.time()), 3),
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": rs.status_code,
+        "bytes": rs.content_length,
+        "id": args.get("user_id", None),
+        "size": args.get("size", None),
+        "privacy": args.get("privacy", 0 if "user_id" in args else None),
+        "cache": g.get("cache", []),
+        "ms": {name: round(total * 1000, 1) for name, (total, count) in (spans or {}).items()},
+    }
+    query = [(k, v) for k, v in request.args.items(multi=True) if k != "profile"]
+    if query:
+        entry["query"] = urllib.parse.urlencode(query)
+    # Small JSON request bodies, so that these can be replayed too
+    if request.endpoint in LOGGED_BODIES:
+        entry["body"] = request.get_data(as_text=True)[:LOGGED_BODIES_MAX]
+    access_logger.info(json.dumps(entry))
+
+def from_peer():
+    # Only requests from other nodes carry the cluster key
+    if g_cluster is None or not has_request_context():
+        return False
+    key = request.headers.get(cluster.KEY_HEADER, None)
+    return key is not None and hmac.compare_digest(key.encode("utf-8"), CLUSTER_KEY.encode("utf-8"))
+
+def shard_key():
+    args = request.view_args or {}
+    if request.endpoint == "get_size_blob":
+        return "u%d" % decode_blob(args["blob"])[0]
+    if "user_id" in args and request.endpoint != "make_blob":
+        return "u%d" % args["user_id"]
+    if "snap" in args:
+        return "s%s" % args["snap"]
+    return None
+
+@app.before_request
+def route_to_owner():
+    # Everything about a producer (or a snapshot) is handled by the node that
+    # owns it, so that it is only fetched, rendered and cached once
+    if g_cluster is None or from_peer():
+        return None
+    key = shard_key()
+    node = g_cluster.owner(key) if key is not None else None
+    if node is None:
+        return None
+    headers = {k: request.headers[k] for k in PROXY_REQUEST_HEADERS if k in request.headers}
+    path = request.path
+    if request.query_string:
+        path += "?" + request.query_string.decode("latin-1")
+    try:
+        with tracing.span("proxy"):
+            status, rs_headers, body = g_cluster.request(node, path, request.method, headers,
+                                                         request.get_data() or None)
+    except cluster.NodeDown:
+        return None
+    except cluster.NodeBusy:
+        # Fetching it here as well would only double the upstream calls
+        return make_response("Busy, try again later\n", 503,
+                             {"Content-Type": "text/plain", "Retry-After": "30"})
+    rs = make_response(body, status)
+    for k in PROXY_RESPONSE_HEADERS:
+        if k in rs_headers:
+            rs.headers[k] = rs_headers[k]
+    return rs
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+def lock_file(path):
+    # flock() on a per-key file serializes producers across worker processes.
+    # The holder unlinks the file when done, so make sure we did not lock a
+    # file that has already been unlinked by the previous holder.
+    while True:
+        fd = open(path, "a")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd.fileno()).st_ino == os.stat(path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        fd.close()
+
+def unlock_file(path, fd):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    fd.close()
+
+def get_refresh_pool():
+    global g_refresh_pool
+    with g_refresh_lock:
+        if g_refresh_pool is None:
+            g_refresh_pool = ThreadPoolExecutor(REFRESH_THREADS, "refresh")
+        return g_refresh_pool
+
+def get_batch_pool():
+    global g_batch_pool
+    with g_refresh_lock:
+        if g_batch_pool is None:
+            g_batch_pool = ThreadPoolExecutor(BATCH_THREADS, "batch")
+        return g_batch_pool
+
+def get_export_pool():
+    global g_export_pool
+    with g_refresh_lock:
+        if g_export_pool is None:
+            g_export_pool = ThreadPoolExecutor(EXPORT_THREADS, "export")
+        return g_export_pool
+
+def schedule_refresh(key, func):
+    pool = get_refresh_pool()
+    with g_refresh_lock:
+        if key in g_refresh_pending:
+            return
+        g_refresh_pending.add(key)
+
+    def run():
+        try:
+            func()
+        except APIError as e:
+            # Upstream down or under maintenance, the stale copy stays
+            app.logger.info("Background refresh of %s failed: API error %d", key, e.code)
+        except Exception:
+            app.logger.exception("Background refresh of %s failed", key)
+        finally:
+            with g_refresh_lock:
+                g_refresh_pending.discard(key)
+
+    pool.submit(run)
+
+def check_cache(store, name, max_age, stale_age=None):
+    mtime = store.mtime(name)
+    if mtime is not None:
+        age = max(0, time.time() - mtime)
         if max_age is None or age < max_age:
-            app.logger.info("Cache hit on %s", path)
-            return path, age
-    tmp = path + ".%08x" % random.randrange(2**64)
-    app.logger.info("Cache miss, fetching at %s", tmp)
-    fetch(tmp)
-    os.rename(tmp, path)
-    age = min(0, time.time() - os.stat(path).st_mtime)
-    return path, age
+            app.logger.info("Cache hit on %s/%s", store.name, name)
+            return name, age
+        if stale_age is not None and age < stale_age:
+            app.logger.info("Stale cache hit on %s/%s (age %d)", store.name, name, age)
+            return name, age
+    return None
+
+def note_cache(store, result):
+    CACHE_REQUESTS.inc(cache=store.name, result=result)
+    if has_request_context():
+        g.setdefault("cache", []).append("%s:%s" % (store.name, result))
+
+def get_cache(store, name, fetch, max_age=None, stale_age=None, refresh=None):
+    start_background()
+    key = (store.name, name)
+    hit = check_cache(store, name, max_age, stale_age)
+    if hit is not None:
+        g_janitor.record_access(store, name)
+        if max_age is not None and hit[1] >= max_age:
+            note_cache(store, "stale")
+            schedule_refresh(key, lambda: get_cache(store, name, refresh or fetch,
+                                                    max_age=max_age))
+        else:
+            note_cache(store, "hit")
+        return hit
+    if fetch is None:
+        return None
+    note_cache(store, "miss")
+
+    with g_flights_lock:
+        flight = g_flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = g_flights[key] = Flight()
+
+    if not leader:
+        app.logger.info("Cache miss, waiting for in-flight fetch of %s/%s", store.name, name)
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        lock_path = LOCK_DIR + "%s_%s.lock" % key
+        lock = lock_file(lock_path)
+        try:
+            # Another process may have produced it while we waited for the lock
+            flight.result = check_cache(store, name, max_age)
+            if flight.result is None:
+                tmp = store.tmp_path(name)
+                app.logger.info("Cache miss, fetching at %s", tmp)
+                with CACHE_FETCH_SECONDS.time(cache=store.name):
+                    fetch(tmp)
+                mtime = store.commit(name, tmp)
+                age = min(0, time.time() - mtime)
+                flight.result = name, age
+        finally:
+            unlock_file(lock_path, lock)
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with g_flights_lock:
+            del g_flights[key]
+        flight.done.set()
+    return flight.result
 
 class APIError(Exception):
     def __init__(self, code):
@@ -105,96 +481,248 @@ def do_check():
         "app_type": 0,
     }
     check = g_client.call("/load/check", args)
-    app.logger.info("Check result: %r", check)
+    app.logger.info("Check result: %r", check, extra={"payload": True})
     return check
 
-def new_resources(res_ver):
-    global g_client, g_resmgr, g_last_check
-    app.logger.info("Resource update: %s -> %s", g_client.res_ver, res_ver)
-    g_client.res_ver = res_ver
-    do_check()
-    g_resmgr = resource_mgr.ResourceManager(g_client.res_ver, RESOURCES_DIR, app.logger)
-    g_last_check = time.time()
-
-def update_resources():
-    global g_lock, g_client, g_last_fetch, g_last_check, g_resmgr
-
-    with g_lock:
-        check_age = time.time() - g_last_check
-        if check_age > RES_POLL or g_resmgr is None:
-            app.logger.info("Check age is %d, invoking check", check_age)
-            check = do_check()
-            if "required_res_ver" in check["data_headers"]:
-                if check["data_headers"]["required_res_ver"] != g_client.res_ver:
+def newer_res_ver(a, b):
+    # res_ver values are version numbers, as strings
+    return a is not None and (b is None or int(a) > int(b))
+
+def check_resources(force=False):
+    global g_resources
+
+    # Only one worker per RES_POLL asks upstream, the rest adopt its result.
+    # A forced check (after a stale res_ver reply) is skipped if another
+    # worker has already moved on to our new res_ver.
+    with g_shared.locked() as state:
+        shared_ver = state.get("res_ver", None)
+        last_check = state.get("last_check", 0)
+        if force:
+            due = shared_ver != g_client.res_ver
+        else:
+            due = time.time() - last_check >= RES_POLL
+            # Never go back: a stale get_profile reply may have just told
+            # us about a version nobody has published yet
+            if not due and newer_res_ver(shared_ver, g_client.res_ver):
+                g_client.res_ver = shared_ver
+        if due:
+            state["last_check"] = time.time()
+
+    if due:
+        try:
+            with g_lock:
+                check = do_check()
+            required = check["data_headers"].get("required_res_ver", None)
+            if required is not None:
+                if required != g_client.res_ver:
                     time.sleep(1.1)
-                    new_resources(check["data_headers"]["required_res_ver"])
+                    with g_lock:
+                        g_client.res_ver = required
+                        do_check()
                 else:
                     app.logger.info("Spurious resource update, API call probably needs fixing")
-            elif check["data_headers"]["result_code"] in (101, 208):
-                g_last_check = time.time()
+        except Exception:
+            g_shared.update(last_check=last_check)
+            raise
+        with g_shared.locked() as state:
+            if newer_res_ver(g_client.res_ver, state.get("res_ver", None)):
+                state["res_ver"] = g_client.res_ver
+            state["last_check"] = time.time()
+
+    # g_client.res_ver may also have been bumped by a stale get_profile reply
+    res_ver = g_client.res_ver
+    if res_ver != g_resources[0]:
+        app.logger.info("Resource update: %s -> %s", g_resources[0], res_ver)
+        g_resources = (res_ver, resource_mgr.ResourceManager(res_ver, RESOURCES_DIR, app.logger))
+        RES_VER_CHANGES.inc()
+    RES_VER.set(int(res_ver))
+
+def poll_resources():
+    force = False
+    while True:
+        try:
+            check_resources(force)
+        except Exception:
+            app.logger.exception("Resource check failed")
+        force = g_poll_event.wait(RES_SYNC)
+        g_poll_event.clear()
+
+def start_background():
+    global g_poller_pid
+    if g_poller_pid == os.getpid():
+        return
+    with g_poller_lock:
+        if g_poller_pid != os.getpid():
+            g_poller_pid = os.getpid()
+            threading.Thread(target=poll_resources, name="res-poller", daemon=True).start()
+            threading.Thread(target=prefetch_popular, name="prefetch", daemon=True).start()
+            g_janitor.start(JANITOR_INTERVAL)
+            metrics.REGISTRY.start(METRICS_DIR, METRICS_INTERVAL)
+
+def get_resources():
+    start_background()
+    return g_resources
+
+def signal_resources():
+    start_background()
+    g_poll_event.set()
+
+def load_info_from_node(user_id, dst, max_age):
+    key = "u%d" % user_id
+    node = None if from_peer() else g_cluster.owner(key)
+    # We own it: a node that owned it before may still have it cached
+    cached = node is None
+    if cached:
+        node = g_cluster.previous_owner(key)
+    if node is None:
+        return False
+    path = "/cluster/info/%d" % user_id
+    args = []
+    if max_age is not None:
+        args.append("max_age=%d" % max_age)
+    if cached:
+        args.append("cached=1")
+    if args:
+        path += "?" + "&".join(args)
+    try:
+        with tracing.span("cluster"):
+            status, headers, record = g_cluster.request(node, path)
+    except cluster.NodeDown:
+        return False
+    except cluster.NodeBusy:
+        raise APIError(101)
+    if status != 200:
+        return False
+    code, data = info.load_result(record)
+    app.logger.info("Got %d from %s (code %d)", user_id, node, code)
+    if code == 101:
+        raise APIError(101)
+    if code == 1457:
+        g_negative.add(user_id)
+    with open(dst, "wb") as fd:
+        fd.write(record)
+    mtime = float(headers.get("X-Mtime", time.time()))
+    os.utime(dst, (mtime, mtime))
+    return True
 
-def load_info(user_id, dst):
-    global g_lock, g_client, g_last_fetch, g_last_check, g_resmgr
+def shared_delay(state):
+    if time.time() - state.get("last_fetch", 0) > THROTTLE_EXPIRY:
+        return THROTTLE
+    return state.get("delay", g_upstream.delay)
+
+@tracing.traced("load_info")
+def load_info(user_id, dst, max_age=DEF_MAX_AGE):
     app.logger.info("Query %d", user_id)
 
-    update_resources()
+    start_background()
 
-    while True:
-        with g_lock:
-            left = g_last_fetch + THROTTLE - time.time()
-            if left > 0:
-                app.logger.info("Throttling: %r sec", left)
-                time.sleep(left)
-
-            d = g_client.call("/profile/get_profile", {"friend_id": user_id})
-            app.logger.info("Result: %r", d)
-            g_last_fetch = time.time()
-            if "required_res_ver" in d["data_headers"]:
-                app.logger.info("Query failed due to stale res_ver, updating")
-                time.sleep(1.1)
-                new_resources(d["data_headers"]["required_res_ver"])
-                continue
-            break
-
-    with open(dst, "w") as fd:
-        json.dump(d, fd)
+    if g_cluster is not None and load_info_from_node(user_id, dst, max_age):
+        return
 
+    try:
+        # Fail fast without queueing on the throttle while upstream is down
+        g_upstream.check()
+        while True:
+            t = time.time()
+            THROTTLE_QUEUE.inc()
+            with tracing.span("queue"):
+                g_lock.acquire()
+            try:
+                THROTTLE_QUEUE.dec()
+                # The AIMD delay is shared too, so the whole host backs off together
+                throttle = g_shared.read()
+                g_upstream.delay = shared_delay(throttle)
+                left = throttle.get("last_fetch", 0) + g_upstream.delay - time.time()
+                if left > 0:
+                    app.logger.info("Throttling: %r sec", left)
+                    with tracing.span("throttle"):
+                        time.sleep(left)
+                THROTTLE_SECONDS.observe(time.time() - t)
+
+                try:
+                    with tracing.span("upstream"):
+                        d = g_upstream.call(g_client.call, "/profile/get_profile", {"friend_id": user_id})
+                except upstream.CircuitOpen:
+                    # Refused before calling upstream, the throttle window stays
+                    raise
+                except Exception:
+                    g_shared.update(last_fetch=time.time(), delay=g_upstream.delay)
+                    raise
+                g_shared.update(last_fetch=time.time(), delay=g_upstream.delay)
+                app.logger.info("Result: %r", d, extra={"payload": True})
+                if "required_res_ver" in d["data_headers"]:
+                    app.logger.info("Query failed due to stale res_ver, signaling poller")
+                    g_client.res_ver = d["data_headers"]["required_res_ver"]
+                    signal_resources()
+                    continue
+                break
+            finally:
+                g_lock.release()
+        if d["data_headers"]["result_code"] == 1457:
+            g_negative.add(user_id)
+    except upstream.CircuitOpen:
+        app.logger.info("Upstream circuit open, not querying %d", user_id)
+        raise APIError(101)
+
+    code = d["data_headers"]["result_code"]
+    if code == 1 and "data" in d:
+        try:
+            record = info.dump_result(code, ProducerInfo(d))
+        except Exception:
+            # Cache the failure too, or every request would query again
+            app.logger.exception("Cannot parse profile of %d", user_id)
+            record = info.dump_result(-1)
+    else:
+        record = info.dump_result(code)
+    with open(dst, "wb") as fd:
+        fd.write(record)
+
+def icon_cache(store, name, getfunc):
+    hit = g_hot.get((store.name, name))
+    if hit is not None:
+        g_janitor.record_access(store, name)
+        return hit[0]
+    name, age = get_cache(store, name, getfunc)
+    png, mtime = store.load(name)
+    g_hot.put((store.name, name), png, mtime, len(png))
+    return png
+
+@tracing.traced("gen_banner")
 def gen_banner(data, dst, mtime=None):
-    update_resources()
+    res_ver, res_mgr = get_resources()
 
     def card_cache(card_id, getfunc):
-        card, age = get_cache(CARD_CACHE_DIR, "%d.png" % card_id, getfunc)
-        return card
+        return icon_cache(CARD_STORE, "%d.png" % card_id, getfunc)
 
     def emblem_cache(emblem_id, getfunc):
-        emblem, age = get_cache(EMBLEM_CACHE_DIR, "%d.png" % emblem_id, getfunc)
-        return emblem
+        return icon_cache(EMBLEM_STORE, "%d.png" % emblem_id, getfunc)
 
     im = render.render_banner(data, card_cache=card_cache, emblem_cache=emblem_cache,
-                              res_mgr=g_resmgr, base=BASE)
-    im.save(dst, "PNG")
+                              res_mgr=res_mgr, base=BASE)
+    with render.RENDER_SECONDS.time(stage="encode"), tracing.span("encode"):
+        im.save(dst, "PNG")
     if mtime is not None:
         os.utime(dst, (mtime, mtime))
 
 def resize_banner(src, dst, size_div):
-    mtime = os.stat(src).st_mtime
-    im = Image.open(src)
+    png, mtime = src
+    im = Image.open(io.BytesIO(png))
     w, h = im.size
     im = im.resize((w//size_div, h//size_div), Image.BICUBIC)
     im.save(dst, "PNG")
     os.utime(dst, (mtime, mtime))
 
 def crop_banner(src, dst):
-    mtime = os.stat(src).st_mtime
-    im = Image.open(src)
+    png, mtime = src
+    im = Image.open(io.BytesIO(png))
     w, h = im.size
     im = im.crop((0, 0, h, h))
     im.save(dst, "PNG")
     os.utime(dst, (mtime, mtime))
 
 def expand_banner(src, dst):
-    mtime = os.stat(src).st_mtime
-    im = Image.open(src)
+    png, mtime = src
+    im = Image.open(io.BytesIO(png))
     w, h = im.size
     #new_h = w * 150 // 280
     #new_im = Image.new('RGBA', (w, new_h), (0, 0, 0, 0))
@@ -204,63 +732,130 @@ def expand_banner(src, dst):
     new_im.save(dst, "PNG")
     os.utime(dst, (mtime, mtime))
 
-def get_data(user_id, max_age=DEF_MAX_AGE):
-    if user_id < 100000000:
+@tracing.traced("get_data")
+def get_data(user_id, max_age=DEF_MAX_AGE, stale_age=STALE_MAX_AGE, cached_only=False):
+    if not 100000000 <= user_id <= 999999999 or user_id in g_negative:
         raise APIError(1457)
-    jsonf, age = get_cache(INFO_CACHE_DIR, "%d.json" % user_id,
-                           lambda f: load_info(user_id, f), max_age=max_age)
-    mtime = os.stat(jsonf).st_mtime
-    with open(jsonf) as fd:
-        data = json.load(fd)
-
-    if data["data_headers"]["result_code"] != 1:
-        raise APIError(data["data_headers"]["result_code"])
-    if "data" not in data:
+
+    # The returned object is shared, see privatize()
+    key = ("info", user_id)
+    hit = g_hot.get(key, max_age)
+    if hit is not None:
+        g_janitor.record_access(INFO_STORE, "%d.json" % user_id)
+        return hit
+
+    fetch = lambda f: load_info(user_id, f, max_age)
+    cached = get_cache(INFO_STORE, "%d.json" % user_id,
+                       None if cached_only else fetch, max_age=max_age,
+                       stale_age=stale_age, refresh=fetch)
+    if cached is None:
+        return None
+    name, age = cached
+
+    # A stale entry in the hot tier is still good if the record is unchanged
+    mtime = INFO_STORE.mtime(name)
+    hit = g_hot.get(key)
+    if hit is not None and hit[1] == mtime:
+        return hit
+
+    raw, mtime = INFO_STORE.load(name)
+    code, data = info.load_result(raw)
+
+    if code != 1:
+        raise APIError(code)
+    if data is None:
         raise Exception("No data returned")
 
-    return ProducerInfo(data), mtime
+    g_hot.put(key, data, mtime, HOT_INFO_SIZE)
+    return data, mtime
 
 def privatize(data, privacy):
+    # Returns a copy, since data may be shared through the hot tier
+    changes = {}
     if privacy >= 1:
-        data.id = None
-        data.last_login_ts = None
-        data.creation_ts = None
+        changes["id"] = None
+        changes["last_login_ts"] = None
+        changes["creation_ts"] = None
     if privacy >= 2:
-        data.name = len(data.name) * "◯"
+        changes["name"] = len(data.name) * "◯"
     if privacy >= 3:
-        data.comment = min(16,len(data.comment)) * "◯"
-
-def get_sized_banner(key, data, mtime, size_div, max_age=DEF_MAX_AGE):
-    master, age = get_cache(BANNER_CACHE_DIR, "%s.png" % key,
-                            lambda f: gen_banner(data, f, mtime),
-                            max_age=max_age)
-    if max_age is not None:
-        cache_timeout = max_age - age
+        changes["comment"] = min(16,len(data.comment)) * "◯"
+    if not changes:
+        return data
+    return data.copy(**changes)
+
+def cache_timeout(age, max_age):
+    if max_age is None:
+        return SNAPSHOT_CACHE_TIMEOUT
+    elif age >= max_age:
+        return STALE_CACHE_TIMEOUT
     else:
-        cache_timeout = None
-
-    if size_div == 1:
-        return send_file(master, mimetype="image/png",
-                         max_age=cache_timeout)
-    elif size_div == -1:
-        sized, age = get_cache(BANNER_CACHE_DIR, "%s_sq.png" % key,
-                            lambda f: crop_banner(master, f),
-                            max_age=max_age)
-        return send_file(sized, mimetype="image/png", max_age=cache_timeout)
+        return max_age - age
+
+def json_response(body, max_age=None, last_modified=None):
+    rs = make_response(body)
+    rs.mimetype = "application/json"
+    rs.set_etag(hashlib.sha1(body.encode("utf-8")).hexdigest())
+    rs.cache_control.public = True
+    if max_age is None:
+        rs.cache_control.max_age = SNAPSHOT_CACHE_TIMEOUT
+        rs.cache_control.immutable = True
+    else:
+        rs.cache_control.max_age = int(max_age)
+    if last_modified is not None:
+        rs.last_modified = last_modified
+    return rs.make_conditional(request)
+
+def load_sized_banner(key, data, mtime, size_div, max_age=DEF_MAX_AGE,
+                      stale_age=None, refresh_data=None):
+    # Each variant is derived from the previous one, starting with the master
+    chain = [("%s.png", None)]
+    if size_div == -1:
+        chain.append(("%s_sq.png", crop_banner))
     elif size_div == -2:
-        sized, age = get_cache(BANNER_CACHE_DIR, "%s_s%d.png" % (key, 2),
-                            lambda f: resize_banner(master, f, 2),
-                            max_age=max_age)
-
-        sized, age = get_cache(BANNER_CACHE_DIR, "%s_tw.png" % key,
-                            lambda f: expand_banner(sized, f),
-                            max_age=max_age)
-        return send_file(sized, mimetype="image/png", max_age=cache_timeout)
-
-    sized, age = get_cache(BANNER_CACHE_DIR, "%s_s%d.png" % (key, size_div),
-                           lambda f: resize_banner(master, f, size_div),
-                           max_age=max_age)
-    return send_file(sized, mimetype="image/png", max_age=cache_timeout)
+        chain.append(("%s_s2.png", lambda src, dst: resize_banner(src, dst, 2)))
+        chain.append(("%s_tw.png", expand_banner))
+    elif size_div != 1:
+        chain.append(("%%s_s%d.png" % size_div,
+                      lambda src, dst: resize_banner(src, dst, size_div)))
+
+    def get_variant(i, fresh=False):
+        name, derive = chain[i]
+        def fetch(dst, fresh=fresh):
+            if derive is not None:
+                derive(BANNER_STORE.load(get_variant(i - 1, fresh)[0]), dst)
+            elif fresh and refresh_data is not None:
+                new_data, new_mtime = refresh_data()
+                gen_banner(new_data, dst, new_mtime)
+            else:
+                gen_banner(data, dst, mtime)
+        return get_cache(BANNER_STORE, name % key, fetch, max_age=max_age,
+                         stale_age=None if fresh else stale_age,
+                         refresh=lambda dst: fetch(dst, True))
+
+    name = chain[-1][0] % key
+    hit = g_hot.get(("banner", name), max_age)
+    if hit is not None:
+        g_janitor.record_access(BANNER_STORE, name)
+        (png, etag), mtime = hit
+        age = max(0, time.time() - mtime)
+    else:
+        name, age = get_variant(len(chain) - 1)
+        png, mtime = BANNER_STORE.load(name)
+        etag = hashlib.sha1(png).hexdigest()
+        if max_age is None or age < max_age:
+            g_hot.put(("banner", name), (png, etag), mtime, len(png))
+    return png, etag, mtime, age
+
+def get_sized_banner(key, data, mtime, size_div, max_age=DEF_MAX_AGE,
+                     stale_age=None, refresh_data=None):
+    png, etag, mtime, age = load_sized_banner(key, data, mtime, size_div, max_age,
+                                              stale_age, refresh_data)
+    rs = send_file(io.BytesIO(png), mimetype="image/png", etag=etag,
+                   max_age=cache_timeout(age, max_age), last_modified=mtime)
+    if max_age is None:
+        rs.cache_control.immutable = True
+    return rs
 
 sizemap = {
     "square": -1,
@@ -272,6 +867,90 @@ sizemap = {
     "huge": 1
 }
 
+def banner_args(user_id, data, privacy):
+    key = "%d_p%d" % (user_id, privacy)
+    def refresh_data():
+        data, mtime = get_data(user_id, stale_age=None)
+        return privatize(data, privacy), mtime
+    return key, privatize(data, privacy), refresh_data
+
+def export_banners(user_ids, sizename, privacy=0):
+    """Yields (filename, png, mtime) for each banner as soon as it is ready,
+    followed by errors.json if any of them failed."""
+    size = sizemap[sizename]
+    def load(user_id):
+        if len(str(user_id)) != 9:
+            raise APIError(1457)
+        data, mtime = get_data(user_id)
+        key, data, refresh_data = banner_args(user_id, data, privacy)
+        png, etag, mtime, age = load_sized_banner(key, data, mtime, size,
+                                                  stale_age=STALE_MAX_AGE,
+                                                  refresh_data=refresh_data)
+        return png, mtime
+
+    user_ids = list(dict.fromkeys(user_ids))
+    futures = dict((get_export_pool().submit(load, i), i) for i in user_ids)
+    errors = {}
+    try:
+        for future in as_completed(futures):
+            user_id = futures[future]
+            try:
+                png, mtime = future.result()
+            except APIError as e:
+                if e.code not in (1457, 101):
+                    app.logger.exception("API error for %r/%r/%r" % (user_id, sizename, privacy))
+                errors[user_id] = {"api_error": e.code}
+                continue
+            except Exception as e:
+                app.logger.exception("Exception thrown for %r/%r/%r" % (user_id, sizename, privacy))
+                errors[user_id] = {"error": -1}
+                continue
+            yield "%d_p%d_%s.png" % (user_id, privacy, sizename), png, mtime
+    finally:
+        # Client gone: drop whatever has not started yet
+        for future in futures:
+            future.cancel()
+    if errors:
+        yield "errors.json", json.dumps(errors, sort_keys=True).encode("ascii"), time.time()
+
+def upstream_idle():
+    try:
+        g_upstream.check()
+    except upstream.CircuitOpen:
+        return False
+    return time.time() - g_shared.get("last_fetch", 0) > 2 * g_upstream.delay
+
+def prefetch(item, max_age):
+    data, mtime = get_data(item[1], max_age=max_age, stale_age=None)
+    if item[0] == "banner":
+        kind, user_id, privacy, sizename = item
+        key, data, refresh_data = banner_args(user_id, data, privacy)
+        load_sized_banner(key, data, mtime, sizemap[sizename], max_age=max_age)
+
+def prefetch_popular():
+    max_age = DEF_MAX_AGE - PREFETCH_AHEAD
+    while True:
+        time.sleep(PREFETCH_INTERVAL)
+        fetched = False
+        for item, count in g_popular.most_common():
+            user_id = item[1]
+            if user_id in g_negative:
+                continue
+            mtime = INFO_STORE.mtime("%d.json" % user_id)
+            if mtime is None or time.time() - mtime >= max_age:
+                # At most one upstream fetch per round, and only when nobody
+                # else wants the throttle; banners of fresh data are always redone
+                if fetched or not upstream_idle():
+                    continue
+                fetched = True
+                PREFETCHES.inc(kind="upstream")
+            try:
+                prefetch(item, max_age)
+            except APIError:
+                pass
+            except Exception:
+                app.logger.exception("Prefetch of %r failed", item)
+
 def try_get_banner(user_id, sizename, privacy=0):
     if sizename.endswith(".png"):
         sizename = sizename[:-4]
@@ -282,9 +961,10 @@ def try_get_banner(user_id, sizename, privacy=0):
     size = sizemap[sizename]
     try:
         data, mtime = get_data(user_id)
-        key = "%d_p%d" % (user_id, privacy)
-        privatize(data, privacy)
-        res = get_sized_banner(key, data, mtime, size)
+        g_popular.add(("banner", user_id, privacy, sizename))
+        key, data, refresh_data = banner_args(user_id, data, privacy)
+        res = get_sized_banner(key, data, mtime, size, stale_age=STALE_MAX_AGE,
+                               refresh_data=refresh_data)
         if data.id is None:
             user_id = 0
         if request.query_string == b"dl":
@@ -316,11 +996,30 @@ def load_snap(snap):
     except:
         abort(404)
 
-    jsonf, age = get_cache(SNAPSHOT_DIR, "%s.json" % snap, lambda p: abort(404))
-    with open(jsonf) as fd:
-        data = ProducerInfo.from_json(fd.read())
+    hit = g_hot.get(("snap", snap))
+    if hit is not None:
+        g_janitor.record_access(SNAPSHOT_STORE, "%s.json" % snap)
+        return hit[0]
+
+    name, age = get_cache(SNAPSHOT_STORE, "%s.json" % snap, lambda p: fetch_snap(snap, p))
+    data = ProducerInfo.load(SNAPSHOT_STORE.load(name)[0])
+    g_hot.put(("snap", snap), data, 0, HOT_INFO_SIZE)
     return data
 
+def fetch_snap(snap, dst):
+    # Snapshots are stored by the node that took them
+    if g_cluster is not None and not from_peer():
+        for node in g_cluster.peers():
+            try:
+                status, headers, d = g_cluster.request(node, "/cluster/snap/" + snap)
+            except (cluster.NodeDown, cluster.NodeBusy):
+                continue
+            if status == 200:
+                with open(dst, "wb") as fd:
+                    fd.write(d)
+                return
+    abort(404)
+
 def try_get_snap(snap, sizename):
     if sizename.endswith(".png"):
         sizename = sizename[:-4]
@@ -336,14 +1035,16 @@ def try_get_snap(snap, sizename):
 
 def try_make_snap(user_id, privacy, tweet=False):
     try:
-        data, mtime = get_data(user_id, max_age=60)
-        privatize(data, privacy)
+        data, mtime = get_data(user_id, max_age=SNAP_MAX_AGE, stale_age=None)
+        data = privatize(data, privacy)
+        # Snapshot names stay derived from the JSON form, so identical
+        # snapshots dedupe against those saved before the binary format
         d = data.to_json().encode("ascii")
         h = base64.b64encode(hashlib.sha1(d).digest()[:12], b"-_").decode("ascii")
-        def save_json(path):
+        def save_snap(path):
             with open(path, "wb") as fd:
-                fd.write(d)
-        get_cache(SNAPSHOT_DIR, "%s.json" % h, save_json)
+                fd.write(data.serialize())
+        get_cache(SNAPSHOT_STORE, "%s.json" % h, save_snap)
         if tweet:
             return redirect("https://twitter.com/intent/tweet?url=https://deresute.me/s/" + h)
         else:
@@ -373,6 +1074,74 @@ def decode_blob(blob):
         abort(400)
     return user_id, privacy
 
+def warm_icons(store, count):
+    entries = []
+    for part in store.parts():
+        entries.extend((atime, name) for name, size, mtime, atime in store.scan(part)
+                       if not storage.is_tmp(name))
+    for atime, name in heapq.nlargest(count, entries):
+        try:
+            png, mtime = store.load(name)
+        except FileNotFoundError:
+            continue
+        g_hot.put((store.name, name), png, mtime, len(png))
+
+def warmup():
+    """Loads everything that workers would otherwise load on their first
+    requests. Run in the gunicorn master before fork (see gunicorn.conf.py),
+    so that workers share it, or lazily by /ready."""
+    global g_warm
+    with g_warm_lock:
+        if g_warm:
+            return
+        t = time.time()
+        # Not get_resources(): this must not start the background threads
+        res_ver, res_mgr = g_resources
+        res_mgr.index()
+        render.warmup(BASE)
+        get_assets()
+        app.jinja_env.get_template("index.html")
+        for store in (CARD_STORE, EMBLEM_STORE):
+            warm_icons(store, WARMUP_ICONS)
+        g_warm = True
+        app.logger.info("Warmed up in %.2f sec", time.time() - t)
+
+def get_assets():
+    global g_assets
+    with g_assets_lock:
+        if g_assets is None:
+            a = assets.Assets(app.static_folder, ASSETS_DIR, "/assets/")
+            a.build()
+            g_assets = a
+        return g_assets
+
+@app.template_global()
+def asset_url(name):
+    return get_assets().url(name)
+
+@app.route("/assets/<path:name>")
+def get_asset(name):
+    found = get_assets().lookup(name, request.accept_encodings.quality)
+    if found is None:
+        abort(404)
+    path, orig_name, encoding = found
+    mimetype = mimetypes.guess_type(orig_name)[0] or "application/octet-stream"
+    rs = send_file(path, mimetype=mimetype, max_age=ASSET_CACHE_TIMEOUT)
+    if encoding is not None:
+        rs.headers["Content-Encoding"] = encoding
+    rs.headers["Vary"] = "Accept-Encoding"
+    rs.headers["Cache-Control"] = "public, max-age=%d, immutable" % ASSET_CACHE_TIMEOUT
+    return rs
+
+@app.route("/ready")
+def get_ready():
+    try:
+        warmup()
+    except Exception:
+        app.logger.exception("Warmup failed")
+        return "not ready\n", 503, {"Content-Type": "text/plain", "Cache-Control": "no-cache"}
+    return "ready\n", 200, {"Content-Type": "text/plain", "Cache-Control": "no-cache"}
+
 @app.route("/")
 def index():
     return render_template('index.html', data=None, snapshot=None)
@@ -404,9 +1173,7 @@ def index_snap(snap):
 @app.route("/s/<snap>/json")
 def get_snap_json(snap):
     data = load_snap(snap)
-    resp = make_response(data.to_json())
-    resp.mimetype = "application/json"
-    return data.to_json(), 200, {"Content-Type": "application/json"}
+    return json_response(data.to_json())
 
 @app.route("/snap/<snap>/<size>")
 @app.route("/s/<snap>/<size>")
@@ -417,9 +1184,9 @@ def get_snap(snap, size):
 def get_json(user_id):
     try:
         data, mtime = get_data(user_id)
-        resp = make_response(data.to_json())
-        resp.mimetype = "application/json"
-        return data.to_json(), 200, {"Content-Type": "application/json"}
+        g_popular.add(("json", user_id))
+        age = max(0, time.time() - mtime)
+        return json_response(data.to_json(), cache_timeout(age, DEF_MAX_AGE), mtime)
     except APIError as e:
         data = {"api_error": e.code}
         if e.code == 1457:
@@ -435,6 +1202,93 @@ def get_json(user_id):
         resp.mimetype = "application/json"
         return resp
 
+def batch_entry(user_id, privacy, cached_only=False):
+    entry = {"id": user_id, "privacy": privacy}
+    try:
+        if len(str(user_id)) != 9:
+            raise APIError(1457)
+        res = get_data(user_id, cached_only=cached_only)
+        if res is None:
+            return None
+        data, mtime = res
+        data = privatize(data, privacy)
+        return '{"id": %d, "privacy": %d, "status": 200, "data": %s}\n' % (
+            user_id, privacy, data.to_json())
+    except APIError as e:
+        entry["api_error"] = e.code
+        if e.code == 1457:
+            entry["status"] = 404
+        elif e.code == 101:
+            entry["status"] = 503
+        else:
+            app.logger.exception("API error for %r" % user_id)
+            entry["status"] = 500
+    except Exception as e:
+        app.logger.exception("Exception thrown for %r" % user_id)
+        entry["status"] = 500
+        entry["error"] = -1
+    return json.dumps(entry) + "\n"
+
+@app.route("/batch/json", methods=['POST'])
+def get_batch_json():
+    # Body: JSON list of IDs or {"id": <id>, "privacy": <level>} objects
+    req = request.get_json(force=True, silent=True)
+    if not isinstance(req, list) or len(req) > BATCH_MAX:
+        abort(400)
+    items = []
+    for i in req:
+        if isinstance(i, dict):
+            user_id, privacy = i.get("id", None), i.get("privacy", 0)
+        else:
+            user_id, privacy = i, 0
+        if not isinstance(user_id, int) or privacy not in (0,1,2,3):
+            abort(400)
+        items.append((user_id, privacy))
+
+    # Answer from cache where possible, and queue everything else at once
+    cached = []
+    pending = []
+    for user_id, privacy in items:
+        line = batch_entry(user_id, privacy, cached_only=True)
+        if line is None:
+            pending.append(get_batch_pool().submit(batch_entry, user_id, privacy))
+        else:
+            cached.append(line)
+
+    def generate():
+        try:
+            for line in cached:
+                yield line
+            for future in as_completed(pending):
+                yield future.result()
+        finally:
+            # Client gone: drop whatever has not started yet
+            for future in pending:
+                future.cancel()
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+@app.route("/export", methods=['POST'])
+def get_export():
+    # Body: {"ids": [...], "size": <size name>, "privacy": <level>, "format": "tar"|"zip"}
+    req = request.get_json(force=True, silent=True)
+    if not isinstance(req, dict):
+        abort(400)
+    user_ids = req.get("ids", None)
+    sizename = req.get("size", "medium")
+    privacy = req.get("privacy", 0)
+    fmt = req.get("format", "tar")
+    if (not isinstance(user_ids, list) or len(user_ids) > BATCH_MAX or
+        not all(isinstance(i, int) for i in user_ids)):
+        abort(400)
+    if sizename not in sizemap or privacy not in (0,1,2,3) or fmt not in export.FORMATS:
+        abort(400)
+
+    rs = Response(export.archive(export_banners(user_ids, sizename, privacy), fmt),
+                  mimetype=export.FORMATS[fmt])
+    rs.headers['Content-Disposition'] = 'attachment; filename=banners_p%d_%s.%s' % (privacy, sizename, fmt)
+    return rs
+
 @app.route("/<int:user_id>/snap", methods=['POST'])
 def make_snap(user_id):
     return try_make_snap(user_id, 0)
@@ -484,22 +1338,93 @@ def get_500():
 
 @app.route("/res_ver")
 def get_res_ver():
-    update_resources()
-    return g_client.res_ver
+    res_ver, res_mgr = get_resources()
+    return res_ver
+
+def derive_resource(res_mgr, asset, md5, width, fmt, dst):
+    if width is None and fmt == "png":
+        im = decode.load_image(open(res_mgr.get(asset), "rb"))
+    else:
+        # Thumbnails and other formats start from the cached full-size decode
+        name, age = get_cache(DERIVED_STORE, "%s_0.png" % md5,
+                              lambda f: derive_resource(res_mgr, asset, md5, None, "png", f))
+        im = Image.open(io.BytesIO(DERIVED_STORE.load(name)[0]))
+        w, h = im.size
+        if width is not None and width < w:
+            im = im.resize((width, max(1, h * width // w)), Image.BICUBIC)
+    im.save(dst, format=fmt.upper())
 
 @app.route("/res/<resource>")
 def get_resource(resource):
-    update_resources()
+    fmt = request.args.get("fmt", "png")
+    width = request.args.get("w", None, type=int)
+    if fmt not in RES_FORMATS or (width is not None and width not in RES_WIDTHS):
+        abort(400)
+    res_ver, res_mgr = get_resources()
+    asset = resource + ".unity3d"
     try:
-        res = g_resmgr.get(resource + ".unity3d")
+        md5, attr = res_mgr.lookup(asset)
     except resource_mgr.ResourceError:
         abort(404)
 
-    im = decode.load_image(open(res, "rb"))
-    fd = io.BytesIO()
-    im.save(fd, format="PNG")
-    rs = make_response(fd.getvalue())
-    rs.headers['Content-Type'] = 'image/png'
+    # Asset bundles are named by their MD5, so whatever is derived from one
+    # never changes. The name -> asset mapping does, hence no immutable here.
+    name = "%s_%d.%s" % (md5, width or 0, fmt)
+    if name in request.if_none_match:
+        rs = make_response("", 304)
+        rs.set_etag(name)
+    else:
+        try:
+            name, age = get_cache(DERIVED_STORE, name,
+                                  lambda dst: derive_resource(res_mgr, asset, md5, width, fmt, dst))
+        except resource_mgr.ResourceError:
+            abort(404)
+        rs = send_file(DERIVED_STORE.path(name), mimetype=RES_FORMATS[fmt], etag=name,
+                       max_age=RESOURCE_CACHE_TIMEOUT)
+    rs.cache_control.public = True
+    rs.cache_control.max_age = RESOURCE_CACHE_TIMEOUT
+    return rs
+
+@app.route("/cluster/info/<int:user_id>")
+def get_cluster_info(user_id):
+    # Raw info cache records, for the other nodes (see load_info_from_node)
+    if not from_peer():
+        abort(404)
+    # Never fresher than any local caller could ask for
+    max_age = max(SNAP_MAX_AGE, request.args.get("max_age", DEF_MAX_AGE, type=int))
+    try:
+        cached = get_data(user_id, max_age=max_age, stale_age=None,
+                          cached_only=bool(request.args.get("cached")))
+        if cached is None:
+            abort(404)
+        data, mtime = cached
+        record = info.dump_result(1, data)
+    except APIError as e:
+        record, mtime = info.dump_result(e.code), time.time()
+    rs = make_response(record)
+    rs.headers['Content-Type'] = 'application/octet-stream'
+    rs.headers['X-Mtime'] = "%.3f" % mtime
+    rs.cache_control.no_cache = True
+    return rs
+
+@app.route("/cluster/snap/<snap>")
+def get_cluster_snap(snap):
+    if not from_peer() or len(snap) != 16:
+        abort(404)
+    hit = check_cache(SNAPSHOT_STORE, "%s.json" % snap, None)
+    if hit is None:
+        abort(404)
+    rs = make_response(SNAPSHOT_STORE.load(hit[0])[0])
+    rs.headers['Content-Type'] = 'application/octet-stream'
+    rs.cache_control.no_cache = True
+    return rs
+
+@app.route("/metrics")
+def get_metrics():
+    start_background()
+    rs = make_response(metrics.REGISTRY.expose())
+    rs.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    rs.cache_control.no_cache = True
     return rs
 
 if __name__ == "__main__":
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# asyncio serving mode: uvicorn asgi:application (or any other ASGI server)
+#
+# Requests are still answered by the Flask app, on a thread pool. But any
+# request that needs a producer's data first waits for it here, as a
+# coroutine: the throttle is awaited instead of slept on, and one upstream
+# thread does the fetching. So requests queued behind the throttle cost a
+# coroutine each instead of a thread, and the WORK_THREADS only ever
+# render, decode and encode.
+
+import asyncio, io, re, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+WORK_THREADS = 8
+UPSTREAM_THREADS = 1
+
+g_work_pool = ThreadPoolExecutor(WORK_THREADS, "work")
+g_upstream_pool = ThreadPoolExecutor(UPSTREAM_THREADS, "upstream")
+g_upstream_lock = None
+g_pending = {}
+
+USER_PATH = re.compile(r"^/(\d+)(?:/|$)")
+BLOB_PATH = re.compile(r"^/([A-Za-z0-9_-]{22})/[^/]+$")
+
+def user_for_path(path):
+    m = USER_PATH.match(path)
+    if m:
+        return int(m.group(1))
+    m = BLOB_PATH.match(path)
+    if m:
+        try:
+            with app.app.test_request_context():
+                return app.decode_blob(m.group(1))[0]
+        except Exception:
+            return None
+    return None
+
+def needs_fetch(user_id):
+    if len(str(user_id)) != 9 or user_id in app.g_negative:
+        return False
+    # Another node will answer it, see app.route_to_owner
+    if app.g_cluster is not None and app.g_cluster.owner("u%d" % user_id) is not None:
+        return False
+    # Stale entries are served (and refreshed) by the app as usual
+    return app.check_cache(app.INFO_STORE, "%d.json" % user_id,
+                           app.DEF_MAX_AGE, app.STALE_MAX_AGE) is None
+
+async def throttle():
+    while True:
+        state = app.g_shared.read()
+        left = state.get("last_fetch", 0) + app.shared_delay(state) - time.time()
+        if left <= 0:
+            return
+        await asyncio.sleep(left)
+
+def fetch(user_id):
+    try:
+        app.get_data(user_id)
+    except app.APIError:
+        # Cached or not, the app turns it into the right response
+        pass
+    except Exception:
+        # Likewise, the request itself will come up with the error response
+        app.app.logger.exception("Fetch of %r failed", user_id)
+
+async def fetch_async(user_id):
+    global g_upstream_lock
+    if g_upstream_lock is None:
+        g_upstream_lock = asyncio.Lock()
+    loop = asyncio.get_running_loop()
+    async with g_upstream_lock:
+        if not needs_fetch(user_id):
+            return
+        try:
+            app.g_upstream.check()
+        except app.upstream.CircuitOpen:
+            return
+        await throttle()
+        await loop.run_in_executor(g_upstream_pool, fetch, user_id)
+
+async def prepare(user_id):
+    # One fetch per producer, however many requests are waiting for it
+    task = g_pending.get(user_id, None)
+    if task is None:
+        task = g_pending[user_id] = asyncio.ensure_future(fetch_async(user_id))
+        task.add_done_callback(lambda t: g_pending.pop(user_id, None))
+    await asyncio.shield(task)
+
+def make_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ[name] = value
+        elif name != "CONTENT_LENGTH":
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+def start_wsgi(environ):
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+    it = iter(app.app.wsgi_app(environ, start_response))
+    # Run up to the first chunk, so that the status is known
+    first = next(it, None)
+    return started[0], started[1], it, first
+
+async def http(scope, receive, send):
+    body = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        body.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+
+    user_id = user_for_path(scope["path"])
+    if user_id is not None and needs_fetch(user_id):
+        await prepare(user_id)
+
+    loop = asyncio.get_running_loop()
+    environ = make_environ(scope, b"".join(body))
+    status, headers, it, chunk = await loop.run_in_executor(g_work_pool, start_wsgi, environ)
+    try:
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+        })
+        # Streamed bodies (batch, export) are pulled one chunk at a time
+        while chunk is not None:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            chunk = await loop.run_in_executor(g_work_pool, next, it, None)
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        if hasattr(it, "close"):
+            await loop.run_in_executor(g_work_pool, it.close)
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await asyncio.get_running_loop().run_in_executor(g_work_pool, app.warmup)
+            except Exception:
+                app.app.logger.exception("Warmup failed")
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope, receive, send):
+    if scope["type"] == "http":
+        await http(scope, receive, send)
+    elif scope["type"] == "lifespan":
+        await lifespan(scope, receive, send)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(application, host="127.0.0.1", port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
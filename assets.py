@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip, hashlib, os, os.path, posixpath, re, sys
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Only worth compressing if the format is not compressed already
+COMPRESSIBLE = (".css", ".js", ".svg", ".ttf", ".eot", ".html", ".json", ".txt")
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+class Assets(object):
+    """Fingerprinted copies of the static files.
+
+    build() copies every file under src_dir to dst_dir as name.<hash>.ext,
+    with .gz (and .br, if the brotli module is available) variants next to
+    it for the compressible types. url() references in CSS files are
+    rewritten to the fingerprinted names first, so a changed font or image
+    also changes the hash of the stylesheets using it.
+
+    Files are named by content, so every process (and every restart) can
+    build into the same directory without stepping on each other.
+    """
+
+    def __init__(self, src_dir, dst_dir, prefix, static_prefix="/static/"):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.prefix = prefix
+        self.static_prefix = static_prefix
+        self.urls = {}
+        self.files = {}
+
+    def _write(self, name, data):
+        path = os.path.join(self.dst_dir, name)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as fd:
+            fd.write(data)
+        os.rename(tmp, path)
+
+    def _add(self, name, data):
+        base, ext = os.path.splitext(name)
+        out = "%s.%s%s" % (base, hashlib.sha1(data).hexdigest()[:12], ext)
+        self._write(out, data)
+        encodings = {}
+        if ext in COMPRESSIBLE:
+            variants = [("gzip", ".gz", lambda d: gzip.compress(d, 9, mtime=0))]
+            if brotli is not None:
+                variants.append(("br", ".br", lambda d: brotli.compress(d, quality=11)))
+            for encoding, suffix, compress in variants:
+                path = os.path.join(self.dst_dir, out + suffix)
+                if not os.path.exists(path):
+                    packed = compress(data)
+                    if len(packed) >= len(data):
+                        continue
+                    self._write(out + suffix, packed)
+                encodings[encoding] = out + suffix
+        self.urls[name] = self.prefix + out
+        self.files[out] = (name, encodings)
+
+    def _rewrite_css(self, name, data):
+        css_dir = posixpath.dirname(name)
+        def repl(m):
+            quote, url = m.groups()
+            split = min([i for i in (url.find("?"), url.find("#")) if i >= 0] or [len(url)])
+            path, suffix = url[:split], url[split:]
+            if path.startswith(self.static_prefix):
+                ref = path[len(self.static_prefix):]
+            elif "://" in path or path.startswith(("/", "data:")):
+                return m.group(0)
+            else:
+                ref = posixpath.normpath(posixpath.join(css_dir, path))
+            if ref not in self.urls:
+                return m.group(0)
+            # Suffixes stay, "?#iefix" is load-bearing for old IE
+            return "url(%s%s%s%s)" % (quote, self.urls[ref], suffix, quote)
+        return CSS_URL.sub(repl, data.decode("utf-8")).encode("utf-8")
+
+    def build(self):
+        names = []
+        for root, dirs, files in os.walk(self.src_dir):
+            for f in files:
+                names.append(os.path.relpath(os.path.join(root, f), self.src_dir).replace(os.sep, "/"))
+        # Stylesheets last, once everything they may refer to has a name
+        for name in sorted(names, key=lambda n: (n.endswith(".css"), n)):
+            with open(os.path.join(self.src_dir, name), "rb") as fd:
+                data = fd.read()
+            if name.endswith(".css"):
+                data = self._rewrite_css(name, data)
+            self._add(name, data)
+
+    def url(self, name):
+        return self.urls.get(name, self.static_prefix + name)
+
+    def lookup(self, out, accept):
+        """Returns (path, original name, content encoding) of the best
+        variant of fingerprinted file out for the given Accept-Encoding
+        qualities (a callable, as werkzeug's request.accept_encodings)."""
+        if out not in self.files:
+            return None
+        name, encodings = self.files[out]
+        for encoding in ("br", "gzip"):
+            if encoding in encodings and accept(encoding):
+                return os.path.join(self.dst_dir, encodings[encoding]), name, encoding
+        return os.path.join(self.dst_dir, out), name, None
+
+if __name__ == "__main__":
+    assets = Assets(sys.argv[1], sys.argv[2], "/assets/")
+    assets.build()
+    for name, url in sorted(assets.urls.items()):
+        print("%s -> %s" % (name, url))
@@ -0,0 +1,195 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Cluster mode: several nodes behind one load balancer, each owning a share
+# of the producers through a consistent-hash ring. The node list is a text
+# file with one base URL per line, shared by all nodes and re-read when it
+# changes. To try it out locally:
+#
+#   (set the same CLUSTER_KEY in every node's keys.py)
+#   printf 'http://127.0.0.1:8001\nhttp://127.0.0.1:8002\n' > nodes.txt
+#   DERESUTE_CLUSTER=nodes.txt DERESUTE_NODE=http://127.0.0.1:8001 \
+#       DERESUTE_DATA=/tmp/node1/ gunicorn -b 127.0.0.1:8001 app:app
+#   (and the same for 8002, with its own data directory)
+#
+#   cluster.py nodes.txt 123456789 ...     # which node owns these IDs
+
+import bisect, hashlib, http.client, os, sys, threading, time, urllib.parse
+
+VNODES = 100
+# Set on requests between nodes; nodes never pass those on again. Only
+# requests with the right cluster key count.
+NODE_HEADER = "X-Deresute-Node"
+KEY_HEADER = "X-Deresute-Cluster-Key"
+
+class NodeDown(Exception):
+    pass
+
+class NodeBusy(Exception):
+    pass
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+class Ring(object):
+    """Consistent-hash ring. Each node gets vnodes points, so adding or
+    removing one node only moves about 1/N of the keys, evenly taken from
+    all the others."""
+
+    def __init__(self, nodes, vnodes=VNODES):
+        self.nodes = sorted(set(nodes))
+        points = []
+        for node in self.nodes:
+            for i in range(vnodes):
+                points.append((hash_key("%s#%d" % (node, i)), node))
+        points.sort()
+        self.hashes = [h for h, node in points]
+        self.owners = [node for h, node in points]
+
+    def owner(self, key):
+        if not self.owners:
+            return None
+        i = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.owners[i]
+
+def load_nodes(path):
+    with open(path) as fd:
+        return [l.strip().rstrip("/") for l in fd if l.strip() and not l.startswith("#")]
+
+class Cluster(object):
+    """This node's view of the cluster: who owns what, and which nodes are
+    currently unreachable. A node that cannot be connected to is skipped
+    for down_time seconds, and its keys are handled locally meanwhile. One
+    that accepts the connection but is slow to answer is only waiting on
+    the throttle like everyone else, so it is not skipped.
+
+    After the node list changes, the previous ring is kept for handoff
+    seconds, so that new owners can pick up entries cached by the old ones.
+    """
+
+    def __init__(self, node, path, key, logger, connect_timeout=2, timeout=120, down_time=30, handoff=3600, check_interval=5):
+        self.node = node.rstrip("/")
+        self.path = path
+        self.key = key
+        self.logger = logger
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.down_time = down_time
+        self.handoff = handoff
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.ring = Ring([])
+        self.previous = None
+        self.changed = 0
+        self.mtime = None
+        self.checked = 0
+        self.down = {}
+        self._reload()
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            nodes = load_nodes(self.path)
+        except OSError as e:
+            self.logger.error("Cannot read cluster node list: %s", e)
+            return
+        if self.node not in nodes:
+            self.logger.warning("This node (%s) is not in %s", self.node, self.path)
+        ring = Ring(nodes)
+        if self.mtime is not None and ring.nodes != self.ring.nodes:
+            self.logger.warning("Cluster nodes changed: %s", ", ".join(ring.nodes))
+            self.previous = self.ring
+            self.changed = time.time()
+        self.ring = ring
+        self.mtime = mtime
+
+    def _check(self):
+        now = time.time()
+        with self.lock:
+            if now - self.checked >= self.check_interval:
+                self.checked = now
+                self._reload()
+            if self.previous is not None and now - self.changed >= self.handoff:
+                self.previous = None
+
+    def alive(self, node):
+        return self.down.get(node, 0) <= time.time()
+
+    def owner(self, key):
+        """Returns the node that owns key, or None if that is us (or the
+        owner is down and we should handle it ourselves)."""
+        self._check()
+        node = self.ring.owner(key)
+        if node is None or node == self.node or not self.alive(node):
+            return None
+        return node
+
+    def previous_owner(self, key):
+        """The owner of key before the last node list change, if it was
+        another node and it is still up."""
+        self._check()
+        ring = self.previous
+        if ring is None:
+            return None
+        node = ring.owner(key)
+        if node is None or node == self.node or node == self.ring.owner(key) or not self.alive(node):
+            return None
+        return node
+
+    def peers(self):
+        self._check()
+        return [node for node in self.ring.nodes if node != self.node and self.alive(node)]
+
+    def request(self, node, path, method="GET", headers={}, body=None):
+        """Sends a request to another node and returns (status, headers,
+        body). Errors (and redirects) are responses too. Raises NodeDown if
+        the node cannot be reached, NodeBusy if it does not answer within
+        timeout."""
+        headers = dict(headers)
+        headers[NODE_HEADER] = self.node
+        headers[KEY_HEADER] = self.key
+        url = urllib.parse.urlsplit(node)
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=self.connect_timeout)
+        try:
+            try:
+                conn.connect()
+            except OSError as e:
+                self.logger.warning("Cluster node %s is down: %s", node, e)
+                self.down[node] = time.time() + self.down_time
+                raise NodeDown(node)
+            conn.sock.settimeout(self.timeout)
+            try:
+                conn.request(method, url.path + path, body=body, headers=headers)
+                rs = conn.getresponse()
+                return rs.status, rs.headers, rs.read()
+            except TimeoutError:
+                self.logger.warning("Cluster node %s did not answer %s in time", node, path)
+                raise NodeBusy(node)
+            except (OSError, http.client.HTTPException) as e:
+                # Connected, then dropped: most likely restarting
+                self.logger.warning("Cluster node %s failed: %s", node, e)
+                self.down[node] = time.time() + self.down_time
+                raise NodeDown(node)
+        finally:
+            conn.close()
+
+if __name__ == "__main__":
+    ring = Ring(load_nodes(sys.argv[1]))
+    for key in sys.argv[2:]:
+        print("%s %s" % (key, ring.owner("u" + key)))
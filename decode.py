@@ -22,6 +22,7 @@ except ImportError:
     pass
 
 import struct, sys
+import tracing
 
 baseStrings = {
     0:b"AABB",
@@ -414,6 +415,7 @@ def decode_image(d):
     else:
         raise Exception("No supported image formats")
 
+@tracing.traced("decode")
 def load_image(fd):
     a = Asset(fd)
     return decode_image(a)
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io, sys, tarfile, time, zipfile
+
+FORMATS = {
+    "tar": "application/x-tar",
+    "zip": "application/zip",
+}
+
+class ChunkWriter(object):
+    # Write-only, unseekable sink: the archive modules fall back to
+    # streaming mode and the caller drains whatever has been written so far
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def archive(entries, fmt="tar"):
+    """Yields a tar or zip archive of (name, data, mtime) entries in chunks,
+    as the entries come in."""
+    out = ChunkWriter()
+    if fmt == "tar":
+        ar = tarfile.open(fileobj=out, mode="w|")
+        def add(name, data, mtime):
+            ti = tarfile.TarInfo(name)
+            ti.size = len(data)
+            ti.mtime = int(mtime)
+            ti.mode = 0o644
+            ar.addfile(ti, io.BytesIO(data))
+    elif fmt == "zip":
+        # PNGs do not compress any further
+        ar = zipfile.ZipFile(out, "w", zipfile.ZIP_STORED)
+        def add(name, data, mtime):
+            zi = zipfile.ZipInfo(name, time.localtime(mtime)[:6])
+            zi.external_attr = 0o644 << 16
+            ar.writestr(zi, data)
+    else:
+        raise ValueError("Unknown archive format %r" % fmt)
+
+    for name, data, mtime in entries:
+        add(name, data, mtime)
+        chunk = out.drain()
+        if chunk:
+            yield chunk
+    ar.close()
+    yield out.drain()
+
+if __name__ == "__main__":
+    # Usage: export.py <size> <privacy> <tar|zip> <user id>... > banners.tar
+    import app
+    size, privacy, fmt = sys.argv[1], int(sys.argv[2]), sys.argv[3]
+    user_ids = [int(i) for i in sys.argv[4:]]
+    for chunk in archive(app.export_banners(user_ids, size, privacy), fmt):
+        sys.stdout.buffer.write(chunk)
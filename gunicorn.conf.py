@@ -0,0 +1,32 @@
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# gunicorn -c gunicorn.conf.py app:app
+
+import gc
+
+# Import the app in the master, so that workers fork off a warmed-up copy
+preload_app = True
+
+def when_ready(server):
+    import app
+    try:
+        app.warmup()
+    except Exception:
+        # Workers will retry lazily, on /ready
+        app.app.logger.exception("Warmup failed")
+    # Keep the collector from touching (and so un-sharing) everything loaded so far
+    gc.freeze()
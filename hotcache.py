@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading, time
+from collections import OrderedDict
+
+class HotCache(object):
+    """Size-bounded in-memory LRU of (value, mtime) pairs.
+
+    Freshness is judged by the caller passing the same max_age it would use
+    for the on-disk cache, so both tiers agree on what is stale. Once full,
+    new keys are only admitted on their second request within the doorkeeper
+    window (a cheap TinyLFU-style filter), so one-off hits from scrapers do
+    not flush out popular entries.
+    """
+
+    def __init__(self, max_bytes, doorkeeper=65536):
+        self.max_bytes = max_bytes
+        self.max_seen = doorkeeper
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.seen = OrderedDict()
+        self.size = 0
+
+    def get(self, key, max_age=None):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            value, mtime, size = entry
+            if max_age is not None and time.time() - mtime >= max_age:
+                return None
+            self.entries.move_to_end(key)
+            return value, mtime
+
+    def _admit(self, key):
+        if key in self.entries or self.size < self.max_bytes:
+            return True
+        if self.seen.pop(key, None) is not None:
+            return True
+        self.seen[key] = True
+        while len(self.seen) > self.max_seen:
+            self.seen.popitem(last=False)
+        return False
+
+    def put(self, key, value, mtime, size):
+        if size > self.max_bytes // 8:
+            return
+        with self.lock:
+            if not self._admit(key):
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (value, mtime, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
@@ -15,11 +15,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json, base64, datetime, pytz, struct
+import json, base64, calendar, datetime, pytz, struct, msgpack
 
 tz = pytz.timezone("Asia/Tokyo")
 
+# Japan has not observed DST since 1951, so JST is a fixed offset
+JST_OFFSET = 9 * 3600
+
 def parse_ts(ts):
+    # Fast path for the fixed "YYYY-MM-DD HH:MM:SS" format
+    if len(ts) == 19 and ts[4] == ts[7] == "-" and ts[10] == " " and ts[13] == ts[16] == ":":
+        try:
+            return calendar.timegm((int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                                    int(ts[11:13]), int(ts[14:16]), int(ts[17:19]))) - JST_OFFSET
+        except ValueError:
+            pass
     dt = tz.localize(datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S"), is_dst=None)
     return int((dt - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds())
 
@@ -64,6 +74,13 @@ class ProducerInfo(object):
         12: "trick",
     }
 
+    KEYS = ["timestamp", "id", "commu_no", "prp", "album_no", "name", "comment",
+            "fan", "level", "rank", "creation_ts", "last_login_ts",
+            "leader_card", "cleared", "full_combo", "emblem_id",
+            "emblem_ex_value", "support_cards"]
+
+    __slots__ = KEYS
+
     def __init__(self, data=None):
         self.emblem_id = 1000001
         self.emblem_ex_value = None
@@ -79,33 +96,32 @@ class ProducerInfo(object):
     def load_data(self, data):
         self.timestamp = int(data["data_headers"]["servertime"])
         d = data["data"]
-        self.name = d["friend_info"]["user_info"]["name"]
-        self.comment = d["friend_info"]["user_info"]["comment"]
-        self.rank = int(d["friend_info"]["user_info"]["producer_rank"])
-        self.level = int(d["friend_info"]["user_info"]["level"])
+        friend_info = d["friend_info"]
+        user_info = friend_info["user_info"]
+        self.name = user_info["name"]
+        self.comment = user_info["comment"]
+        self.rank = int(user_info["producer_rank"])
+        self.level = int(user_info["level"])
         self.prp = int(d["prp"])
-        self.fan = int(d["friend_info"]["user_info"]["fan"])
+        self.fan = int(user_info["fan"])
         self.commu_no = int(d["story_number"])
         self.album_no = int(d["album_number"])
-        self.creation_ts = parse_ts(d["friend_info"]["user_info"]["create_time"])
-        self.last_login_ts = parse_ts(d["friend_info"]["user_info"]["last_login_time"])
-        self.id = d["friend_info"]["user_info"]["viewer_id"]
-        self.emblem_id = int(d["friend_info"]["user_info"].get("emblem_id", 1000001))
-        self.emblem_ex_value = int(d["friend_info"]["user_info"].get("emblem_ex_value", 0)) or None
+        self.creation_ts = parse_ts(user_info["create_time"])
+        self.last_login_ts = parse_ts(user_info["last_login_time"])
+        self.id = user_info["viewer_id"]
+        self.emblem_id = int(user_info.get("emblem_id", 1000001))
+        self.emblem_ex_value = int(user_info.get("emblem_ex_value", 0)) or None
         if self.emblem_id == 0:
             self.emblem_id = 1000001
 
-        self.leader_card = parse_card(d["friend_info"]["leader_card_info"],
-                                      d["friend_info"]["user_chara_potential"], "chara_0")
+        potential = friend_info["user_chara_potential"]
+        support = friend_info["support_card_info"]
+        self.leader_card = parse_card(friend_info["leader_card_info"], potential, "chara_0")
         self.support_cards = {
-            "cute":    parse_card(d["friend_info"]["support_card_info"]["1"],
-                                  d["friend_info"]["user_chara_potential"], "chara_1"),
-            "cool":    parse_card(d["friend_info"]["support_card_info"]["2"],
-                                  d["friend_info"]["user_chara_potential"], "chara_2"),
-            "passion": parse_card(d["friend_info"]["support_card_info"]["3"],
-                                  d["friend_info"]["user_chara_potential"], "chara_3"),
-            "all":     parse_card(d["friend_info"]["support_card_info"]["4"],
-                                  d["friend_info"]["user_chara_potential"], "chara_4"),
+            "cute":    parse_card(support["1"], potential, "chara_1"),
+            "cool":    parse_card(support["2"], potential, "chara_2"),
+            "passion": parse_card(support["3"], potential, "chara_3"),
+            "all":     parse_card(support["4"], potential, "chara_4"),
         }
 
         self.cleared = {i: 0 for i in list(self.DIFFICULTIES.values())}
@@ -118,14 +134,53 @@ class ProducerInfo(object):
             self.cleared[self.DIFFICULTIES[dt]] = int(i["clear_number"])
             self.full_combo[self.DIFFICULTIES[dt]] = int(i["full_combo_number"])
 
-    KEYS = ["timestamp", "id", "commu_no", "prp", "album_no", "name", "comment",
-            "fan", "level", "rank", "creation_ts", "last_login_ts",
-            "leader_card", "cleared", "full_combo", "emblem_id",
-            "emblem_ex_value", "support_cards"]
+    # Binary format: MAGIC, version byte, msgpack list of the values of the
+    # keys listed for that version. Add a new version when KEYS changes.
+    MAGIC = b"PI"
+    VERSION = 1
+    SERIAL_KEYS = {
+        1: KEYS,
+    }
+
+    def __eq__(self, other):
+        return all(getattr(self, k, None) == getattr(other, k, None) for k in self.KEYS)
+
+    def copy(self, **changes):
+        # Shallow: nested dicts are shared, so treat them as read-only
+        other = ProducerInfo.__new__(ProducerInfo)
+        for k in self.KEYS:
+            if k in changes:
+                setattr(other, k, changes[k])
+            elif hasattr(self, k):
+                setattr(other, k, getattr(self, k))
+        return other
 
     def to_json(self):
         return json.dumps({k: getattr(self, k) for k in self.KEYS})
 
+    def serialize(self):
+        return (self.MAGIC + bytes([self.VERSION]) +
+                msgpack.packb([getattr(self, k) for k in self.SERIAL_KEYS[self.VERSION]]))
+
+    @staticmethod
+    def unserialize(d):
+        if d[:2] != ProducerInfo.MAGIC:
+            raise ValueError("Not a serialized ProducerInfo")
+        if d[2] not in ProducerInfo.SERIAL_KEYS:
+            raise ValueError("Unknown ProducerInfo version %d" % d[2])
+        self = ProducerInfo()
+        values = msgpack.unpackb(d[3:], strict_map_key=False)
+        for k, v in zip(ProducerInfo.SERIAL_KEYS[d[2]], values):
+            setattr(self, k, v)
+        return self
+
+    @staticmethod
+    def load(d):
+        # Snapshots saved before the binary format are JSON
+        if d[:1] == b"{":
+            return ProducerInfo.from_json(d.decode("utf-8"))
+        return ProducerInfo.unserialize(d)
+
     @staticmethod
     def from_json(j):
         self = ProducerInfo()
@@ -137,6 +192,31 @@ class ProducerInfo(object):
             self.emblem_id = 1000001
         return self
 
+# Info cache records: result code of the get_profile call, followed by the
+# serialized ProducerInfo if there was one
+RESULT_MAGIC = b"PR"
+
+def dump_result(code, info=None):
+    d = RESULT_MAGIC + struct.pack("<i", code)
+    if info is not None:
+        d += info.serialize()
+    return d
+
+def load_result(d):
+    # Older caches hold the raw get_profile reply as JSON
+    if d[:1] == b"{":
+        data = json.loads(d.decode("utf-8"))
+        code = data["data_headers"]["result_code"]
+        if code != 1 or "data" not in data:
+            return code, None
+        return code, ProducerInfo(data)
+    if d[:2] != RESULT_MAGIC:
+        raise ValueError("Not an info cache record")
+    code, = struct.unpack("<i", d[2:6])
+    if len(d) == 6:
+        return code, None
+    return code, ProducerInfo.unserialize(d[6:])
+
 if __name__ == "__main__":
     import sys, pickle
 
@@ -151,14 +231,12 @@ if __name__ == "__main__":
     print(j)
     p2 = ProducerInfo.from_json(j)
     
-    assert p1.__dict__ == p2.__dict__
-    #print
-    #print "serialize:"
-    #ser = p1.serialize()
-    #print ser.encode("hex")
-    #print
-    #p3 = ProducerInfo.unserialize(ser)
-    #assert p1.__dict__ == p3.__dict__
-    
-    #p2 = ProducerInfo.from_json(open("error.json").read()).serialize()
+    assert p1 == p2
+    print()
+    print("serialize:")
+    ser = p1.serialize()
+    print(ser.hex())
+    print("%d bytes (JSON: %d bytes)" % (len(ser), len(j)))
+    p3 = ProducerInfo.unserialize(ser)
+    assert p1 == p3
     
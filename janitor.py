@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl, math, os, os.path, shutil, sqlite3, threading, time
+
+import storage
+
+class Janitor(object):
+    """Incremental background cleanup of the data/ caches.
+
+    Work is split into small tasks (one store shard, the resource cache, the
+    lock directory) and one task runs per step. Only one process on the host
+    runs the tasks; every process records accesses, which are written back
+    to the stores as access times, and added up in a host-wide hit count
+    database (halved every cycle), so eviction sees all workers' traffic.
+    """
+
+    def __init__(self, logger, lock_path, hits_path, tmp_max_age=3600, freq_weight=3600):
+        self.logger = logger
+        self.lock_path = lock_path
+        self.hits_path = hits_path
+        self.tmp_max_age = tmp_max_age
+        # Seconds of recency each doubling of the hit count is worth
+        self.freq_weight = freq_weight
+
+        self.tasks = []
+        self.cursor = 0
+        self.cycle_freed = 0
+        self.reclaimed = 0
+        self.leader = None
+        self.pid = None
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pending = {}
+
+        db = self._db()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS hits "
+                       "(store TEXT, name TEXT, count INTEGER, PRIMARY KEY (store, name))")
+        # Opened before the workers fork, must not be inherited by them
+        db.close()
+        self.local.db = None
+
+    def _db(self):
+        # Same rules as SqliteStorage: one connection per thread and process
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.hits_path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def add_store(self, store, max_bytes=None, max_age=None):
+        parts = store.parts()
+        budget = None if max_bytes is None else max_bytes // len(parts)
+        for part in parts:
+            self.tasks.append(("%s/%s" % (store.name, part or ""),
+                               lambda store=store, part=part: self.clean_store(store, part, budget, max_age)))
+
+    def add_resources(self, res_dir, get_manager, get_version, min_age=3600):
+        self.tasks.append(("resources", lambda: self.clean_resources(res_dir, get_manager(),
+                                                                     get_version(), min_age)))
+
+    def add_locks(self, lock_dir):
+        self.tasks.append(("locks", lambda: self.clean_locks(lock_dir)))
+
+    def record_access(self, store, name):
+        with self.lock:
+            names = self.pending.setdefault(store, {})
+            names[name] = names.get(name, 0) + 1
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        for store, names in pending.items():
+            store.touch(names)
+        with self._db() as db:
+            db.executemany("INSERT INTO hits (store, name, count) VALUES (?, ?, ?) "
+                           "ON CONFLICT (store, name) DO UPDATE SET count = count + excluded.count",
+                           ((store.name, name, count) for store, names in pending.items()
+                            for name, count in names.items()))
+
+    def _hits(self, store):
+        return dict(self._db().execute("SELECT name, count FROM hits WHERE store = ?",
+                                       (store.name,)))
+
+    def _score(self, hits, entry):
+        name, size, mtime, atime = entry
+        return atime + self.freq_weight * math.log2(1 + hits.get(name, 0))
+
+    def clean_store(self, store, part, max_bytes, max_age):
+        now = time.time()
+        freed = 0
+        total = 0
+        entries = []
+        for entry in store.scan(part):
+            name, size, mtime, atime = entry
+            if storage.is_tmp(name):
+                # Left behind by a crashed or killed fetch
+                if now - mtime > self.tmp_max_age and store.delete(name):
+                    freed += size
+            elif max_age is not None and now - mtime > max_age:
+                if store.delete(name):
+                    freed += size
+            else:
+                entries.append(entry)
+                total += size
+
+        if max_bytes is not None and total > max_bytes:
+            hits = self._hits(store)
+            entries.sort(key=lambda e: self._score(hits, e))
+            for name, size, mtime, atime in entries:
+                if total <= max_bytes * 0.9:
+                    break
+                if store.delete(name):
+                    freed += size
+                total -= size
+
+        if freed:
+            store.compact()
+        return freed
+
+    def _remove(self, path):
+        try:
+            if os.path.isdir(path):
+                size = sum(os.path.getsize(os.path.join(dp, f))
+                           for dp, dn, fn in os.walk(path) for f in fn)
+                shutil.rmtree(path)
+            else:
+                size = os.path.getsize(path)
+                os.unlink(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def clean_resources(self, res_dir, mgr, version, min_age):
+        # Workers pick up a new res_ver at their own pace. Until this process
+        # has caught up with the host-wide version, "not in our manifest"
+        # may well mean "just downloaded for the new one", so wait.
+        if version is None or str(version) != str(mgr.res_ver):
+            return 0
+        # Assets are stored by MD5, so anything not in the current manifest
+        # belongs to an older res_ver
+        hashes = mgr.hashes()
+        now = time.time()
+        freed = 0
+        for sub in ("storage", "unlz4"):
+            base = os.path.join(res_dir, sub, "dl")
+            if not os.path.isdir(base):
+                continue
+            for entry in os.scandir(base):
+                if (entry.is_dir() and entry.name.isdigit() and int(entry.name) < int(version)
+                    and now - entry.stat().st_mtime > min_age):
+                    freed += self._remove(entry.path)
+            for dp, dn, fn in os.walk(os.path.join(base, "resources")):
+                for name in fn:
+                    path = os.path.join(dp, name)
+                    try:
+                        age = now - os.path.getmtime(path)
+                    except FileNotFoundError:
+                        continue
+                    if "." in name:
+                        if age > self.tmp_max_age:
+                            freed += self._remove(path)
+                    elif name not in hashes and age > min_age:
+                        freed += self._remove(path)
+        return freed
+
+    def clean_locks(self, lock_dir):
+        now = time.time()
+        for entry in os.scandir(lock_dir):
+            if not entry.name.endswith(".lock") or now - entry.stat().st_mtime < self.tmp_max_age:
+                continue
+            with open(entry.path, "a") as fd:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.unlink(entry.path)
+        return 0
+
+    def _is_leader(self):
+        if self.leader is None:
+            fd = open(self.lock_path, "a")
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                fd.close()
+                return False
+            self.logger.info("Janitor running in this process")
+            self.leader = fd
+        return True
+
+    def step(self):
+        self.flush()
+        if not self.tasks or not self._is_leader():
+            return 0
+
+        label, task = self.tasks[self.cursor]
+        try:
+            freed = task()
+        except Exception:
+            self.logger.exception("Janitor task %s failed", label)
+            freed = 0
+        if freed:
+            self.logger.info("Janitor: reclaimed %d bytes from %s", freed, label)
+        self.reclaimed += freed
+        self.cycle_freed += freed
+
+        self.cursor = (self.cursor + 1) % len(self.tasks)
+        if self.cursor == 0:
+            self.logger.info("Janitor: cycle complete, reclaimed %d bytes (%d total)",
+                             self.cycle_freed, self.reclaimed)
+            self.cycle_freed = 0
+            # Old popularity fades, and entries nobody asks for drop out
+            with self._db() as db:
+                db.execute("DELETE FROM hits WHERE count <= 1")
+                db.execute("UPDATE hits SET count = count / 2")
+        return freed
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.step()
+            except Exception:
+                self.logger.exception("Janitor step failed")
+
+    def start(self, interval):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.leader = None
+        threading.Thread(target=self.run, args=(interval,), name="janitor", daemon=True).start()
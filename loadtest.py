@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Offline, in-process load test of the whole app.
+#
+# The game API is replaced by canned profile replies and the asset server by
+# the icons shipped in the repo; everything else (caches, throttle, render)
+# is the real thing, running in a scratch data directory. Results are
+# compared against loadtest_baseline.json (recorded with --no-render and the
+# default request count); a run with nothing to compare against fails too.
+#
+#   loadtest.py [--scenario mixed] [--requests 2000] [--threads 8]
+#   loadtest.py --save       # record the current numbers as the baseline
+
+import argparse, json, os, random, shutil, sys, tempfile, threading, time
+
+BASE = os.path.dirname(os.path.abspath(__file__)) + "/"
+BASELINE_FILE = BASE + "loadtest_baseline.json"
+
+# hot: number of popular IDs, hot_share: fraction of requests going to them,
+# the rest pick a never seen before ID. The remaining fractions choose the
+# request type; whatever is left over is banners.
+SCENARIOS = {
+    "mixed": dict(hot=50, hot_share=0.8, json=0.25, blob=0.1, snap=0.1),
+    "hot":   dict(hot=10, hot_share=1.0, json=0.25, blob=0.1, snap=0.1),
+    "cold":  dict(hot=0, hot_share=0.0, json=0.5, blob=0.0, snap=0.0),
+}
+
+SIZES = ["square", "twcard", "twitter", "small", "medium", "large", "huge"]
+
+def profile_reply(user_id):
+    card = {"card_id": 100001 + user_id % 50 * 2, "level": 40, "love": 50,
+            "step": 0, "skill_level": 1, "exp": 0}
+    return {
+        "data_headers": {"result_code": 1, "servertime": int(time.time())},
+        "data": {
+            "friend_info": {
+                "user_info": {
+                    "viewer_id": user_id, "name": "P%d" % (user_id % 1000),
+                    "comment": "load test", "producer_rank": 1 + user_id % 9,
+                    "level": 100 + user_id % 200, "fan": user_id % 3000000,
+                    "create_time": "2016-01-01 00:00:00",
+                    "last_login_time": "2020-01-01 12:00:00",
+                    "emblem_id": 1000001,
+                },
+                "leader_card_info": card,
+                "user_chara_potential": {},
+                "support_card_info": {"1": card, "2": card, "3": card, "4": card},
+            },
+            "prp": 1000, "story_number": 10, "album_number": 100,
+            "user_live_difficulty_list": [
+                {"difficulty_type": i, "clear_number": 100, "full_combo_number": 10}
+                for i in (1, 2, 3, 4, 5)],
+        },
+    }
+
+class FixtureResources(object):
+    # Stands in for ResourceManager: every card is chihiro, every emblem the same
+    def __init__(self, base):
+        self.base = base
+
+    def index(self):
+        return {}
+
+    def hashes(self):
+        return set()
+
+    def lookup(self, name):
+        return ("0" * 32, 0)
+
+    def get(self, name):
+        if name.startswith("emblem_"):
+            return self.base + "emblem_s.png"
+        return self.base + "chihiro2x.png"
+
+def setup(args):
+    data_dir = tempfile.mkdtemp(prefix="deresute-loadtest-")
+    os.environ["DERESUTE_DATA"] = data_dir + "/"
+
+    import apiclient, decode, render
+    from PIL import Image
+
+    counts = {"upstream": 0, "render": 0}
+    lock = threading.Lock()
+
+    def call(self, path, params):
+        with lock:
+            counts["upstream"] += 1
+        time.sleep(args.upstream_latency)
+        if path == "/profile/get_profile":
+            return profile_reply(params["friend_id"])
+        return {"data_headers": {"result_code": 1}}
+    apiclient.ApiClient.call = call
+
+    decode.load_image = lambda fd: Image.open(fd).convert("RGBA")
+
+    render_banner = render.render_banner
+    def counted_render(*a, **kw):
+        with lock:
+            counts["render"] += 1
+        if args.no_render:
+            return Image.new("RGBA", (1120, 600))
+        return render_banner(*a, **kw)
+    render.render_banner = counted_render
+
+    import app
+    import logging
+    app.app.logger.setLevel(logging.WARNING)
+    app.g_resources = (app.g_resources[0], FixtureResources(app.BASE))
+    # Measure the app, not the upstream throttle
+    app.THROTTLE = app.g_upstream.delay = app.g_upstream.min_delay = 0
+    app.g_shared.update(delay=0)
+    return app, counts, data_dir
+
+def make_requests(app, scenario, n, seed):
+    rnd = random.Random(seed)
+    client = app.app.test_client()
+    hot = [100000000 + i * 7919 for i in range(scenario["hot"])]
+    cold = iter(range(500000000, 600000000, 13))
+
+    # Blobs and snapshots need a round trip to create, done before timing
+    blobs = []
+    snaps = []
+    for user_id in hot[:10]:
+        if scenario["blob"]:
+            privacy = rnd.randint(1, 3)
+            blobs.append(client.get("/%d/p%d/blob" % (user_id, privacy)).data.decode("ascii"))
+        if scenario["snap"]:
+            privacy = rnd.randint(0, 3)
+            if privacy:
+                rs = client.post("/%d/p%d/snap" % (user_id, privacy))
+            else:
+                rs = client.post("/%d/snap" % user_id)
+            snaps.append(rs.headers["Location"].rsplit("/", 1)[1])
+
+    reqs = []
+    for i in range(n):
+        if hot and rnd.random() < scenario["hot_share"]:
+            # Roughly Zipf-distributed popularity
+            user_id = hot[min(len(hot) - 1, int(rnd.paretovariate(1.2)) - 1)]
+        else:
+            user_id = next(cold)
+        size = rnd.choice(SIZES)
+        r = rnd.random()
+        if r < scenario["json"]:
+            reqs.append("/%d/json" % user_id)
+        elif r < scenario["json"] + scenario["blob"] and blobs:
+            reqs.append("/%s/%s" % (rnd.choice(blobs), size))
+        elif r < scenario["json"] + scenario["blob"] + scenario["snap"] and snaps:
+            snap = rnd.choice(snaps)
+            reqs.append("/s/%s/%s" % (snap, rnd.choice(SIZES + ["json"])))
+        else:
+            privacy = rnd.randint(0, 3)
+            if privacy:
+                reqs.append("/%d/p%d/%s" % (user_id, privacy, size))
+            else:
+                reqs.append("/%d/%s" % (user_id, size))
+    return reqs
+
+def run(app, reqs, threads):
+    results = [None] * len(reqs)
+    next_req = iter(range(len(reqs)))
+    lock = threading.Lock()
+
+    def worker():
+        client = app.app.test_client()
+        while True:
+            with lock:
+                i = next(next_req, None)
+            if i is None:
+                return
+            t = time.perf_counter()
+            rs = client.get(reqs[i])
+            rs.get_data()
+            results[i] = (time.perf_counter() - t, rs.status_code)
+
+    t = time.perf_counter()
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - t, results
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def compare(result, baseline, tolerance, count_tolerance):
+    failures = []
+    if result["rps"] < baseline["rps"] * (1 - tolerance):
+        failures.append("rps")
+    for key in ("p50_ms", "p99_ms"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            failures.append(key)
+    for key in ("upstream_calls", "renders", "errors"):
+        if result[key] > baseline[key] * (1 + count_tolerance) + 1:
+            failures.append(key)
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test")
+    parser.add_argument("--scenario", default="mixed", choices=sorted(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    parser.add_argument("--no-render", action="store_true",
+                        help="replace the SVG render with a blank image")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative throughput/latency regression")
+    parser.add_argument("--count-tolerance", type=float, default=0.05,
+                        help="allowed relative increase in upstream calls, renders and errors")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    args = parser.parse_args()
+
+    app, counts, data_dir = setup(args)
+    try:
+        scenario = SCENARIOS[args.scenario]
+        reqs = make_requests(app, scenario, args.requests, args.seed)
+        counts["upstream"] = counts["render"] = 0
+        elapsed, results = run(app, reqs, args.threads)
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    latencies = [r[0] for r in results]
+    result = {
+        "requests": len(results),
+        "rps": round(len(results) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "errors": sum(1 for r in results if r[1] >= 500),
+        "upstream_calls": counts["upstream"],
+        "renders": counts["render"],
+    }
+    name = args.scenario + ("-norender" if args.no_render else "")
+    print("%s: %s" % (name, json.dumps(result, sort_keys=True)))
+
+    try:
+        with open(args.baseline) as fd:
+            baselines = json.load(fd)
+    except FileNotFoundError:
+        baselines = {}
+
+    if args.save:
+        baselines[name] = result
+        with open(args.baseline, "w") as fd:
+            json.dump(baselines, fd, indent=2, sort_keys=True)
+            fd.write("\n")
+        print("Baseline saved to %s" % args.baseline)
+        return 0
+
+    baseline = baselines.get(name, None)
+    if baseline is None:
+        print("No baseline for %s (run with --save to record one)" % name)
+        return 1
+    if baseline["requests"] != result["requests"]:
+        print("Baseline was recorded with %d requests, not comparing" % baseline["requests"])
+        return 0
+    failures = compare(result, baseline, args.tolerance, args.count_tolerance)
+    for key in sorted(result):
+        print("  %-15s %10s  (baseline %s)%s" % (key, result[key], baseline[key],
+                                                 "  REGRESSION" if key in failures else ""))
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
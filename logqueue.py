@@ -0,0 +1,188 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit, json, logging, logging.handlers, os, queue, random, smtplib, threading, time
+from email.message import EmailMessage
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hands records over to a listener thread that does the formatting and
+    I/O. The request thread only captures its context (via the context
+    callable) and decides whether to keep payload records.
+
+    Records logged with extra={"payload": True} carry large objects (API
+    replies and the like): only a `sample` fraction of them is kept, and
+    their message is cut to max_payload characters.
+    """
+
+    def __init__(self, handlers, context=None, sample=1.0, max_payload=4096):
+        logging.handlers.QueueHandler.__init__(self, queue.SimpleQueue())
+        self.handlers = handlers
+        self.context = context
+        self.sample = sample
+        self.max_payload = max_payload
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def start(self):
+        # The listener thread does not survive fork(), so each process runs its own
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.listener = logging.handlers.QueueListener(self.queue, *self.handlers,
+                                                           respect_handler_level=True)
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            for handler in self.handlers:
+                handler.flush()
+
+    def filter(self, record):
+        if not logging.handlers.QueueHandler.filter(self, record):
+            return False
+        if (getattr(record, "payload", False) and record.levelno < logging.WARNING
+            and random.random() >= self.sample):
+            return False
+        return True
+
+    def prepare(self, record):
+        # Formatting is left to the listener; arguments are passed as they are
+        if self.context is not None:
+            try:
+                record.context = self.context()
+            except Exception:
+                record.context = None
+        if getattr(record, "payload", False):
+            record.max_length = self.max_payload
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        logging.handlers.QueueHandler.emit(self, record)
+
+def get_message(record):
+    msg = record.getMessage()
+    max_length = getattr(record, "max_length", None)
+    if max_length is not None and len(msg) > max_length:
+        msg = msg[:max_length] + "... (%d more)" % (len(msg) - max_length)
+    return msg
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def __init__(self, **fields):
+        logging.Formatter.__init__(self)
+        self.fields = fields
+
+    def format(self, record):
+        d = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        d.update(self.fields)
+        context = getattr(record, "context", None)
+        if context:
+            d.update(context)
+        d["msg"] = get_message(record)
+        if record.exc_info:
+            d["exc"] = self.formatException(record.exc_info)
+        return json.dumps(d, ensure_ascii=False, default=repr)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        context = getattr(record, "context", None)
+        if context:
+            ctx = " ".join("[%s]" % v for v in context.values())
+        else:
+            ctx = "[SYS]"
+        s = "[%s] [%d] %s %s" % (self.formatTime(record), record.process, ctx, get_message(record))
+        if record.exc_info:
+            s += "\n" + self.formatException(record.exc_info)
+        return s
+
+class BatchingSMTPHandler(logging.Handler):
+    """Mails error records in batches: at most one mail per interval, with
+    up to max_records records in it and a count of the ones left out."""
+
+    def __init__(self, mailhost, fromaddr, toaddr, subject, interval=300, max_records=50):
+        logging.Handler.__init__(self)
+        self.mailhost = mailhost
+        self.fromaddr = fromaddr
+        self.toaddr = toaddr
+        self.subject = subject
+        self.interval = interval
+        self.max_records = max_records
+        self.records = []
+        self.dropped = 0
+        self.last_sent = 0
+        self.timer = None
+        self.setFormatter(TextFormatter())
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # The parent still owns (and will send) whatever it had queued up
+        self.records = []
+        self.dropped = 0
+        self.timer = None
+
+    def emit(self, record):
+        with self.lock:
+            if len(self.records) >= self.max_records:
+                self.dropped += 1
+                return
+            self.records.append(self.format(record))
+            if self.timer is None:
+                delay = max(0, self.last_sent + self.interval - time.time())
+                self.timer = threading.Timer(delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            records, dropped = self.records, self.dropped
+            self.records, self.dropped = [], 0
+            self.timer = None
+            self.last_sent = time.time()
+        if not records:
+            return
+        msg = EmailMessage()
+        msg["From"] = self.fromaddr
+        msg["To"] = self.toaddr
+        msg["Subject"] = "%s (%d errors, pid %d)" % (self.subject, len(records) + dropped, os.getpid())
+        body = "\n\n".join(records)
+        if dropped:
+            body += "\n\n... and %d more" % dropped
+        msg.set_content(body)
+        try:
+            with smtplib.SMTP(self.mailhost) as smtp:
+                smtp.send_message(msg)
+        except Exception:
+            self.handleError(logging.makeLogRecord({"msg": body}))
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush()
+        logging.Handler.close(self)
@@ -0,0 +1,265 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib, fcntl, json, os, os.path, random, threading, time
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metric(object):
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[i]) for i in self.labels)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+class Gauge(Metric):
+    """Per-process value, combined across processes with mode ("sum" or
+    "max"). Values from processes that have exited are dropped."""
+    type = "gauge"
+
+    def __init__(self, registry, name, help, labels=(), mode="sum"):
+        Metric.__init__(self, registry, name, help, labels)
+        self.merge = max if mode == "max" else (lambda a, b: a + b)
+
+    def set(self, value, **labels):
+        with self.registry.lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.registry.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, registry, name, help, labels=(), buckets=TIME_BUCKETS):
+        Metric.__init__(self, registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # Per-bucket (not cumulative) counts, then sum and count
+        with self.registry.lock:
+            v = self.values.get(key)
+            if v is None:
+                v = self.values[key] = [0] * (len(self.buckets) + 3)
+            for i, le in enumerate(self.buckets):
+                if value <= le:
+                    v[i] += 1
+                    break
+            else:
+                v[len(self.buckets)] += 1
+            v[-2] += value
+            v[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - t, **labels)
+
+    @staticmethod
+    def merge(a, b):
+        return [x + y for x, y in zip(a, b)]
+
+class Registry(object):
+    """Metrics for one process, plus aggregation across all the worker
+    processes sharing a directory.
+
+    Each process periodically dumps its values to <dir>/<pid>.json.
+    Counters and histograms of processes that have exited are folded into
+    <dir>/dead.json, so totals never go backwards.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+        self.dir = None
+        self.flushed = None
+        self.thread = None
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        # Values inherited across fork() belong to the parent
+        self.lock = threading.Lock()
+        for m in self.metrics:
+            m.values.clear()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def counter(self, *args, **kwargs):
+        return Counter(self, *args, **kwargs)
+
+    def gauge(self, *args, **kwargs):
+        return Gauge(self, *args, **kwargs)
+
+    def histogram(self, *args, **kwargs):
+        return Histogram(self, *args, **kwargs)
+
+    def _dump(self):
+        with self.lock:
+            return dict((m.name, [[list(k), v] for k, v in m.values.items()])
+                        for m in self.metrics if m.values)
+
+    def _read(self, path):
+        try:
+            with open(path) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write(self, path, state):
+        tmp = path + ".%08x" % random.randrange(2**64)
+        with open(tmp, "w") as fd:
+            json.dump(state, fd)
+        os.rename(tmp, path)
+
+    def _merge(self, total, state, live=True):
+        for m in self.metrics:
+            if m.name not in state or (m.type == "gauge" and not live):
+                continue
+            values = total.setdefault(m.name, {})
+            for k, v in state[m.name]:
+                k = tuple(k)
+                values[k] = v if k not in values else m.merge(values[k], v)
+
+    def _reap(self, paths):
+        # Called with the dead.json lock held
+        dead_path = os.path.join(self.dir, "dead.json")
+        total = {}
+        self._merge(total, self._read(dead_path), live=False)
+        for path in paths:
+            self._merge(total, self._read(path), live=False)
+        self._write(dead_path, dict((name, [[list(k), v] for k, v in values.items()])
+                                    for name, values in total.items()))
+        for path in paths:
+            os.unlink(path)
+
+    def _locked(self):
+        fd = open(os.path.join(self.dir, "dead.lock"), "a")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def flush(self):
+        if self.dir is None:
+            return
+        pid = os.getpid()
+        path = os.path.join(self.dir, "%d.json" % pid)
+        if self.flushed != pid:
+            # Leftovers from an earlier process that had the same pid
+            self.flushed = pid
+            if os.path.exists(path):
+                with self._locked():
+                    self._reap([path])
+        self._write(path, self._dump())
+
+    def collect(self):
+        """Returns {name: {label values: value}} summed over all processes."""
+        self.flush()
+        total = {}
+        with self._locked():
+            live, dead = [], []
+            for entry in os.scandir(self.dir):
+                pid = entry.name.split(".")[0]
+                if not pid.isdigit() or entry.name != pid + ".json":
+                    continue
+                try:
+                    os.kill(int(pid), 0)
+                    live.append(entry.path)
+                except ProcessLookupError:
+                    dead.append(entry.path)
+                except PermissionError:
+                    live.append(entry.path)
+            if dead:
+                self._reap(dead)
+            self._merge(total, self._read(os.path.join(self.dir, "dead.json")), live=False)
+            for path in live:
+                self._merge(total, self._read(path))
+        return total
+
+    def expose(self):
+        """Prometheus text exposition format."""
+        total = self.collect()
+        out = []
+        for m in self.metrics:
+            out.append("# HELP %s %s" % (m.name, m.help))
+            out.append("# TYPE %s %s" % (m.name, m.type))
+            for k, v in sorted(total.get(m.name, {}).items()):
+                labels = ['%s="%s"' % (l, val.replace("\\", "\\\\").replace('"', '\\"'))
+                          for l, val in zip(m.labels, k)]
+                if m.type != "histogram":
+                    out.append("%s%s %s" % (m.name, fmt_labels(labels), fmt_value(v)))
+                    continue
+                count = 0
+                for le, n in zip(m.buckets + ("+Inf",), v):
+                    count += n
+                    out.append("%s_bucket%s %d" % (m.name, fmt_labels(labels + ['le="%s"' % le]), count))
+                out.append("%s_sum%s %s" % (m.name, fmt_labels(labels), fmt_value(v[-2])))
+                out.append("%s_count%s %d" % (m.name, fmt_labels(labels), v[-1]))
+        return "\n".join(out) + "\n"
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def start(self, path, interval):
+        self.dir = path
+        if self.thread == os.getpid():
+            return
+        self.thread = os.getpid()
+        os.makedirs(path, exist_ok=True)
+        self.flush()
+        threading.Thread(target=self.run, args=(interval,), name="metrics", daemon=True).start()
+
+def fmt_labels(labels):
+    return "{%s}" % ",".join(labels) if labels else ""
+
+def fmt_value(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib, math, os, random, struct, threading, time
+from collections import OrderedDict
+
+class BloomFilter(object):
+    def __init__(self, bits, hashes, data=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.count = 0
+        if data is None:
+            self.data = bytearray((bits + 7) // 8)
+        else:
+            self.data = bytearray(data)
+
+    @classmethod
+    def for_capacity(cls, capacity, fp_rate):
+        bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(bits / capacity * math.log(2))))
+        return cls(bits, hashes)
+
+    def _positions(self, key):
+        h1, h2 = struct.unpack("<QQ", hashlib.blake2b(struct.pack("<Q", key), digest_size=16).digest())
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, key):
+        for i in self._positions(key):
+            self.data[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.data[i >> 3] & (1 << (i & 7)) for i in self._positions(key))
+
+    def merge(self, other):
+        if (other.bits, other.hashes) != (self.bits, self.hashes):
+            return
+        self.data = bytearray(a | b for a, b in zip(self.data, other.data))
+        self.count += other.count
+
+class NegativeCache(object):
+    """Set of IDs known not to exist, with entries expiring after roughly ttl.
+
+    The last `recent` IDs are kept exactly with their timestamps. Everything
+    is also added to a pair of Bloom filter generations that rotate every ttl
+    seconds (or when full), so older entries cost a few bits each and expire
+    after between ttl and 2*ttl.
+    """
+    MAGIC = b"NEG1"
+    HEADER = struct.Struct("<4sdQIII")
+
+    def __init__(self, path, logger, ttl=86400, capacity=200000, fp_rate=1e-6,
+                 recent=50000, save_interval=60):
+        self.path = path
+        self.logger = logger
+        self.ttl = ttl
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.max_recent = recent
+        self.save_interval = save_interval
+
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()
+        self.current = BloomFilter.for_capacity(capacity, fp_rate)
+        self.previous = BloomFilter.for_capacity(capacity, fp_rate)
+        self.rotated = 0
+        self.dirty = False
+        self.last_sync = 0
+        self.file_mtime = None
+        with self.lock:
+            self._sync(force=True)
+            if not self.rotated:
+                self.rotated = time.time()
+
+    def _rotate(self, now):
+        if now - self.rotated < self.ttl and self.current.count < self.capacity:
+            return
+        self.previous = self.current
+        self.current = BloomFilter.for_capacity(self.capacity, self.fp_rate)
+        self.rotated = now
+        self.dirty = True
+
+    def __contains__(self, user_id):
+        now = time.time()
+        with self.lock:
+            self._sync()
+            self._rotate(now)
+            ts = self.recent.get(user_id)
+            if ts is not None:
+                if now - ts < self.ttl:
+                    return True
+                del self.recent[user_id]
+                return False
+            return user_id in self.current or user_id in self.previous
+
+    def add(self, user_id):
+        now = time.time()
+        with self.lock:
+            self._rotate(now)
+            self.recent[user_id] = now
+            self.recent.move_to_end(user_id)
+            while len(self.recent) > self.max_recent:
+                self.recent.popitem(last=False)
+            self.current.add(user_id)
+            self.dirty = True
+            self._sync()
+
+    def discard(self, user_id):
+        # Bloom filters cannot forget, so this only helps for recent entries
+        with self.lock:
+            self.recent.pop(user_id, None)
+
+    def _merge(self, other):
+        if other.rotated > self.rotated:
+            self.current, self.previous = other.current, other.previous
+            self.rotated = other.rotated
+            for user_id in self.recent:
+                self.current.add(user_id)
+        elif other.rotated == self.rotated:
+            self.current.merge(other.current)
+            self.previous.merge(other.previous)
+        elif other.rotated > self.rotated - self.ttl:
+            self.previous.merge(other.current)
+        for user_id, ts in other.recent.items():
+            if ts > self.recent.get(user_id, 0):
+                self.recent[user_id] = ts
+        if len(self.recent) > self.max_recent:
+            items = sorted(self.recent.items(), key=lambda i: i[1])[-self.max_recent:]
+            self.recent = OrderedDict(items)
+
+    def _sync(self, force=False):
+        # Pick up entries added by other processes, then persist ours
+        now = time.time()
+        if not force and now - self.last_sync < self.save_interval:
+            return
+        self.last_sync = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime != self.file_mtime:
+            try:
+                with open(self.path, "rb") as fd:
+                    self._merge(self._load(fd.read()))
+            except Exception:
+                self.logger.exception("Failed to load negative cache %s", self.path)
+            self.file_mtime = mtime
+        if self.dirty:
+            self._save()
+
+    def _load(self, data):
+        magic, rotated, bits, hashes, cur_count, prev_count = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("Bad magic")
+        size = (bits + 7) // 8
+        other = NegativeCache.__new__(NegativeCache)
+        off = self.HEADER.size
+        other.rotated = rotated
+        other.current = BloomFilter(bits, hashes, data[off:off + size])
+        other.current.count = cur_count
+        other.previous = BloomFilter(bits, hashes, data[off + size:off + 2 * size])
+        other.previous.count = prev_count
+        off += 2 * size
+        n, = struct.unpack_from("<I", data, off)
+        other.recent = OrderedDict(struct.iter_unpack("<Qd", data[off + 4:off + 4 + 16 * n]))
+        return other
+
+    def _save(self):
+        data = [self.HEADER.pack(self.MAGIC, self.rotated, self.current.bits,
+                                 self.current.hashes, self.current.count,
+                                 self.previous.count),
+                bytes(self.current.data), bytes(self.previous.data),
+                struct.pack("<I", len(self.recent))]
+        data += [struct.pack("<Qd", k, v) for k, v in self.recent.items()]
+        tmp = self.path + ".%08x" % random.randrange(2**64)
+        with open(tmp, "wb") as fd:
+            fd.write(b"".join(data))
+        os.rename(tmp, self.path)
+        self.file_mtime = os.stat(self.path).st_mtime
+        self.dirty = False
+
+    def save(self):
+        with self.lock:
+            if self.dirty:
+                self._save()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib, threading, time
+
+class Popularity(object):
+    """Decaying access frequencies, estimated with a count-min sketch, plus
+    the top_k most popular keys seen so far.
+
+    All counts are halved every half_life seconds, so keys that stop being
+    requested drop out of the top list again.
+    """
+
+    def __init__(self, top_k=100, width=8192, depth=4, half_life=3600):
+        self.top_k = top_k
+        self.width = width
+        self.depth = depth
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.counts = [[0.0] * width for i in range(depth)]
+        self.top = {}
+        self.floor = 0
+        self.decayed = time.time()
+
+    def _slots(self, key):
+        h = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        return [(h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def _decay(self):
+        for row in self.counts:
+            for i, v in enumerate(row):
+                if v:
+                    row[i] = v / 2
+        for key in self.top:
+            self.top[key] /= 2
+        self.floor /= 2
+        self.decayed = time.time()
+
+    def add(self, key, weight=1):
+        slots = self._slots(key)
+        with self.lock:
+            if time.time() - self.decayed >= self.half_life:
+                self._decay()
+            est = None
+            for row, i in zip(self.counts, slots):
+                row[i] += weight
+                est = row[i] if est is None else min(est, row[i])
+            if key in self.top:
+                self.top[key] = est
+            elif len(self.top) < self.top_k:
+                self.top[key] = est
+                self.floor = min(self.top.values())
+            elif est > self.floor:
+                del self.top[min(self.top, key=self.top.get)]
+                self.top[key] = est
+                self.floor = min(self.top.values())
+
+    def estimate(self, key):
+        slots = self._slots(key)
+        with self.lock:
+            return min(row[i] for row, i in zip(self.counts, slots))
+
+    def most_common(self, n=None):
+        with self.lock:
+            items = sorted(self.top.items(), key=lambda i: -i[1])
+        return items[:n] if n is not None else items
@@ -15,13 +15,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import cairo, gi, base64, datetime, pytz, time, urllib.request, urllib.parse, urllib.error, decode, io, PIL
+import cairo, gi, base64, copy, datetime, pytz, time, urllib.request, urllib.parse, urllib.error, decode, io, PIL
 from PIL import Image
 gi.require_version('Rsvg', '2.0')
 from gi.repository import Rsvg
 import xml.etree.ElementTree as ET
 
-import apiclient
+import apiclient, metrics, tracing
+
+RENDER_SECONDS = metrics.histogram("deresute_render_seconds", "Banner render time by stage", ("stage",))
 
 ns = {'svg': "http://www.w3.org/2000/svg"}
 xlink = "{http://www.w3.org/1999/xlink}"
@@ -40,9 +42,28 @@ def get_emblem(emblemid, mgr, f):
     im = decode.load_image(open(path, "rb"))
     im.save(f, format="PNG", compress_level=0)
 
+g_templates = {}
+
+def load_template(base=""):
+    # Parsed once per process (or before fork, see warmup()); renders edit a copy
+    root = g_templates.get(base, None)
+    if root is None:
+        root = g_templates[base] = ET.parse(base + 'banner.svg').getroot()
+    return copy.deepcopy(root)
+
+def warmup(base=""):
+    # Loads librsvg, fontconfig and the template's fonts, which would
+    # otherwise happen during the first render in every process
+    root = load_template(base)
+    width, height = int(root.attrib["width"]), int(root.attrib["height"])
+    img = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    ctx = cairo.Context(img)
+    Rsvg.Handle().new_from_data(ET.tostring(root)).render_cairo(ctx)
+
+@tracing.traced("render")
 def render_banner(data, res_mgr, card_cache=None, emblem_cache=None, base=""):
-    tree = ET.parse(base + 'banner.svg')
-    root = tree.getroot()
+    t = time.time()
+    root = load_template(base)
     width, height = int(root.attrib["width"]), int(root.attrib["height"])
 
     if "image_id" in data.leader_card:
@@ -58,20 +79,22 @@ def render_banner(data, res_mgr, card_cache=None, emblem_cache=None, base=""):
             get_card(image_id, res_mgr, output)
             card_icon = output.getvalue()
         else:
-            card_file = card_cache(image_id,
+            card_icon = card_cache(image_id,
                                    lambda f: get_card(image_id,
                                                       res_mgr, f))
-            card_icon = open(card_file, "rb").read()
 
     if emblem_cache is None:
         output = io.BytesIO()
         get_emblem(data.emblem_id, res_mgr, output)
         emblem_icon = output.getvalue()
     else:
-        emblem_file = emblem_cache(data.emblem_id,
+        emblem_icon = emblem_cache(data.emblem_id,
                                 lambda f: get_emblem(data.emblem_id,
                                                     res_mgr, f))
-        emblem_icon = open(emblem_file, "rb").read()
+
+    t2 = time.time()
+    RENDER_SECONDS.observe(t2 - t, stage="icons")
+    t = t2
 
     icon_uri = "data:image/png;base64," + base64.b64encode(card_icon).decode("ascii")
     emblem_uri = "data:image/png;base64," + base64.b64encode(emblem_icon).decode("ascii")
@@ -121,6 +144,10 @@ def render_banner(data, res_mgr, card_cache=None, emblem_cache=None, base=""):
         if (i+1) != data.rank and not (rank == "sss" and data.rank == 100):
             root.find('.//svg:g[@id="rk_%s"]'%rank, ns).clear()
 
+    t2 = time.time()
+    RENDER_SECONDS.observe(t2 - t, stage="svg")
+    t = t2
+
     img = cairo.ImageSurface(cairo.FORMAT_ARGB32, 2*width, 2*height)
     ctx = cairo.Context(img)
     handle = Rsvg.Handle().new_from_data(ET.tostring(root))
@@ -128,6 +155,7 @@ def render_banner(data, res_mgr, card_cache=None, emblem_cache=None, base=""):
     handle.render_cairo(ctx)
     im = Image.frombuffer("RGBA", (2*width, 2*height),
                           bytes(img.get_data()), "raw", "BGRA", 0, 1)
+    RENDER_SECONDS.observe(time.time() - t, stage="rasterize")
     return im
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Plays an access log (DERESUTE_ACCESS_LOG) back against a test instance,
+# keeping the original gaps between requests, optionally sped up:
+#
+#   replay.py access.log http://localhost:8000 [--speed 10] [--threads 64]
+#
+# The summary compares how each request was served (cached, rendered or
+# fetched upstream, going by the Server-Timing spans) in production and in
+# the replay, along with the replay latencies.
+
+import argparse, collections, json, sys, time, urllib.request, urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args):
+        return None
+
+g_opener = urllib.request.build_opener(NoRedirect)
+
+def load(path, limit=None):
+    entries = []
+    with open(path) as fd:
+        for line in fd:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if "t" in entry and "path" in entry:
+                entries.append(entry)
+    entries.sort(key=lambda e: e["t"])
+    return entries[:limit]
+
+def served_by(spans):
+    if "upstream" in spans:
+        return "upstream"
+    if "gen_banner" in spans:
+        return "render"
+    return "cache"
+
+def parse_server_timing(header):
+    spans = {}
+    for item in (header or "").split(","):
+        parts = item.strip().split(";")
+        for part in parts[1:]:
+            if part.startswith("dur="):
+                spans[parts[0]] = float(part[4:])
+    return spans
+
+def send(base_url, entry):
+    url = base_url + entry["path"]
+    if entry.get("query"):
+        url += "?" + entry["query"]
+    method = entry.get("method", "GET")
+    body = entry.get("body", None)
+    headers = {}
+    if body:
+        headers["Content-Type"] = "application/json"
+    data = (body or "").encode("utf-8") if method == "POST" else None
+    req = urllib.request.Request(url, method=method, data=data, headers=headers)
+    t = time.perf_counter()
+    try:
+        with g_opener.open(req) as rs:
+            rs.read()
+            status, timing = rs.status, rs.headers.get("Server-Timing")
+    except urllib.error.HTTPError as e:
+        e.read()
+        status, timing = e.code, e.headers.get("Server-Timing")
+    except Exception:
+        status, timing = None, None
+    return time.perf_counter() - t, status, parse_server_timing(timing)
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def replay(entries, base_url, speed, threads):
+    results = [None] * len(entries)
+    lateness = []
+    pool = ThreadPoolExecutor(threads)
+
+    def run(i, due):
+        # Late starts mean the replay itself could not keep up
+        lateness.append(max(0, time.perf_counter() - due))
+        results[i] = send(base_url, entries[i])
+
+    t0 = entries[0]["t"]
+    start = time.perf_counter()
+    for i, entry in enumerate(entries):
+        due = start + (entry["t"] - t0) / speed if speed else start
+        wait = due - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+        pool.submit(run, i, max(due, start))
+    pool.shutdown(wait=True)
+    return time.perf_counter() - start, results, lateness
+
+def summarize(entries, elapsed, results, lateness):
+    print("%d requests in %.1fs (%.1f req/s), log spanned %.1fs" % (
+        len(entries), elapsed, len(entries) / elapsed, entries[-1]["t"] - entries[0]["t"]))
+    print("Replay start lateness: p50 %.1fms, p99 %.1fms" % (
+        percentile(lateness, 0.5) * 1000, percentile(lateness, 0.99) * 1000))
+
+    statuses = collections.Counter(r[1] for r in results)
+    print("Status: " + ", ".join("%s: %d" % (k, v) for k, v in sorted(statuses.items(), key=str)))
+
+    before = collections.Counter(served_by(e.get("ms", {})) for e in entries)
+    after = collections.Counter(served_by(r[2]) for r in results if r[1] is not None)
+    print("\n%-10s %10s %10s" % ("served by", "original", "replay"))
+    for kind in ("cache", "render", "upstream"):
+        print("%-10s %9.1f%% %9.1f%%" % (kind, 100.0 * before[kind] / len(entries),
+                                         100.0 * after[kind] / len(entries)))
+
+    caches = collections.Counter()
+    for e in entries:
+        caches.update(e.get("cache", []))
+    if caches:
+        print("\nOriginal cache lookups:")
+        for key, count in sorted(caches.items()):
+            print("  %-20s %d" % (key, count))
+
+    by_endpoint = collections.defaultdict(list)
+    for e, r in zip(entries, results):
+        by_endpoint[e.get("endpoint") or "?"].append((e, r))
+    print("\n%-20s %6s %10s %10s %10s %10s" % ("endpoint", "count", "orig p50", "p50", "p99", "max"))
+    for endpoint, items in sorted(by_endpoint.items(), key=lambda i: -len(i[1])):
+        orig = [e.get("ms", {}).get("total", 0) for e, r in items]
+        lat = [r[0] * 1000 for e, r in items]
+        print("%-20s %6d %9.1fms %8.1fms %8.1fms %8.1fms" % (
+            endpoint, len(items), percentile(orig, 0.5), percentile(lat, 0.5),
+            percentile(lat, 0.99), max(lat)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an access log")
+    parser.add_argument("log")
+    parser.add_argument("base_url")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="time compression factor (0: no delays at all)")
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    entries = load(args.log, args.limit)
+    if not entries:
+        print("No entries in %s" % args.log)
+        return 1
+    elapsed, results, lateness = replay(entries, args.base_url.rstrip("/"), args.speed, args.threads)
+    summarize(entries, elapsed, results, lateness)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
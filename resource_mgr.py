@@ -15,7 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import urllib.request, urllib.error, urllib.parse, hashlib, sys, os, os.path, struct, sqlite3, random, logging, errno
+import urllib.request, urllib.error, urllib.parse, hashlib, sys, os, os.path, struct, sqlite3, random, logging, errno, time
+import metrics, tracing
 
 try:
     import lz4.block
@@ -24,6 +25,9 @@ except ImportError:
     import lz4
     lz4_decompress = lz4.loads
 
+FETCH_BYTES = metrics.counter("deresute_resource_fetch_bytes_total", "Bytes downloaded from the asset server")
+FETCH_SECONDS = metrics.histogram("deresute_resource_fetch_seconds", "Asset download time")
+
 def unlz4(path):
     fd = open(path, "rb")
     magic, uncomp, comp, unk = struct.unpack("<IIII", fd.read(16))
@@ -44,6 +48,7 @@ class ResourceManager(object):
         self.platform = "Android"
         self.alvl = "High"
         self.slvl = "High"
+        self.manifest = None
 
     def _makedirs(self, path):
         dir, name = os.path.split(path)
@@ -70,8 +75,11 @@ class ResourceManager(object):
         self.logger.info("Fetch: %s -> %s", url, dest)
         req = urllib.request.Request(url)
         req.add_header("X-Unity-Version", "2017.4.2f2")
+        t = time.time()
         response = urllib.request.urlopen(req)
         data = response.read()
+        FETCH_SECONDS.observe(time.time() - t)
+        FETCH_BYTES.inc(len(data))
         if md5 is not None:
             if hashlib.md5(data).hexdigest() != md5:
                 raise ResourceError("MD5 digest mismatch for %s" % path)
@@ -105,6 +113,19 @@ class ResourceManager(object):
         con.row_factory = sqlite3.Row
         return con
 
+    def index(self):
+        # name -> (hash, attr), loaded once and shared by every lookup (and,
+        # when loaded before fork, by every worker)
+        if self.manifest is None:
+            con = self.load_manifest()
+            self.manifest = dict((row["name"], (row["hash"], row["attr"]))
+                                 for row in con.execute("SELECT name, hash, attr FROM manifests"))
+            con.close()
+        return self.manifest
+
+    def hashes(self):
+        return set(h for h, attr in self.index().values())
+
     def get_asset_dl_path(self, manifest_entry):
         name = manifest_entry["name"]
         md5 = manifest_entry["hash"]
@@ -125,20 +146,22 @@ class ResourceManager(object):
         return path
         
 
-    def get(self, name):
-        con = self.load_manifest()
-        cur = con.cursor()
-
-        cur.execute("SELECT * FROM manifests WHERE name = ?", (name,))
-        row = cur.fetchone()
-        if row is None:
+    def lookup(self, name):
+        # (hash, attr) of an asset, without downloading it
+        entry = self.index().get(name, None)
+        if entry is None:
             raise ResourceError("Resource %s not found in manifest", name)
+        return entry
+
+    @tracing.traced("resource")
+    def get(self, name):
+        md5, attr = self.lookup(name)
 
-        unlz4 = bool(row["attr"] & 1)
-        if row["attr"] & ~1:
-            raise ResourceError("Unknown attributes: 0x%x" % row["attr"])
+        unlz4 = bool(attr & 1)
+        if attr & ~1:
+            raise ResourceError("Unknown attributes: 0x%x" % attr)
 
-        path = self.get_asset_dl_path(row)
+        path = self.get_asset_dl_path({"name": name, "hash": md5})
         
         if unlz4:
             return self.fetch_lz4(path)
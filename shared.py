@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib, fcntl, json
+
+class SharedState(object):
+    """Small JSON dict shared by every process on the host.
+
+    The file is its own lock: readers take a shared flock, writers an
+    exclusive one and rewrite it in place. Holding locked() for longer than
+    a read-modify-write would stall every other worker, so it is not meant
+    for anything slow.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _open(self, mode):
+        fd = open(self.path, "a+")
+        fcntl.flock(fd, mode)
+        fd.seek(0)
+        try:
+            state = json.loads(fd.read() or "{}")
+        except ValueError:
+            state = {}
+        return fd, state
+
+    def read(self):
+        fd, state = self._open(fcntl.LOCK_SH)
+        fd.close()
+        return state
+
+    def get(self, key, default=None):
+        return self.read().get(key, default)
+
+    @contextlib.contextmanager
+    def locked(self):
+        fd, state = self._open(fcntl.LOCK_EX)
+        try:
+            old = dict(state)
+            yield state
+            if state != old:
+                fd.seek(0)
+                fd.truncate()
+                fd.write(json.dumps(state))
+                fd.flush()
+        finally:
+            fd.close()
+
+    def update(self, **changes):
+        with self.locked() as state:
+            state.update(changes)
+
+class HostLock(object):
+    """Exclusive lock shared by the threads of this process and every
+    other process on the host."""
+
+    def __init__(self, path, lock):
+        self.path = path
+        self.lock = lock
+        self.fd = None
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            fd = open(self.path, "a")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except:
+            self.lock.release()
+            raise
+        self.fd = fd
+
+    def release(self):
+        fd, self.fd = self.fd, None
+        fd.close()
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
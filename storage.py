@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno, hashlib, os, os.path, random, sqlite3, sys, threading, time
+
+class Storage(object):
+    """Named blob store backing one of the data/ caches.
+
+    Producers write into a temporary file from tmp_path() and hand it over
+    with commit(), which preserves the file's mtime as the entry's mtime.
+    If legacy_dir is set, entries missing from the store are also looked up
+    in the old flat directory layout, so a store can be switched before its
+    contents have been migrated.
+    """
+
+    def __init__(self, name, legacy_dir=None):
+        self.name = name
+        self.legacy_dir = legacy_dir
+
+    def _legacy_mtime(self, name):
+        if self.legacy_dir is None:
+            return None
+        try:
+            return os.stat(self.legacy_dir + name).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _legacy_load(self, name):
+        if self.legacy_dir is None:
+            raise FileNotFoundError(errno.ENOENT, "Not in %s store" % self.name, name)
+        with open(self.legacy_dir + name, "rb") as fd:
+            return fd.read(), os.fstat(fd.fileno()).st_mtime
+
+    def mtime(self, name):
+        mtime = self._mtime(name)
+        if mtime is None:
+            mtime = self._legacy_mtime(name)
+        return mtime
+
+    def load(self, name):
+        try:
+            return self._load(name)
+        except FileNotFoundError:
+            return self._legacy_load(name)
+
+    def parts(self):
+        # Independent slices of the store that can be scanned one at a time
+        return [None]
+
+    def compact(self):
+        pass
+
+    def put(self, name, data, mtime=None):
+        tmp = self.tmp_path(name)
+        with open(tmp, "wb") as fd:
+            fd.write(data)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        return self.commit(name, tmp)
+
+def is_tmp(name):
+    # Temporary files are named <name>.<random hex>
+    return name.count(".") > 1
+
+class FileStorage(Storage):
+    """One file per entry, optionally sharded into levels of 256 directories
+    by a hash of the name."""
+
+    def __init__(self, name, root, shard=2, legacy_dir=None):
+        Storage.__init__(self, name, legacy_dir)
+        self.root = root
+        self.shard = shard
+
+    def _dir(self, name):
+        if not self.shard:
+            return self.root
+        h = hashlib.md5(name.encode("utf-8")).hexdigest()
+        return self.root + "".join(h[2*i:2*i+2] + "/" for i in range(self.shard))
+
+    def _mtime(self, name):
+        try:
+            return os.stat(self._dir(name) + name).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def _load(self, name):
+        with open(self._dir(name) + name, "rb") as fd:
+            return fd.read(), os.fstat(fd.fileno()).st_mtime
+
+    def path(self, name):
+        path = self._dir(name) + name
+        if self.legacy_dir is not None and not os.path.exists(path):
+            if os.path.exists(self.legacy_dir + name):
+                return self.legacy_dir + name
+        return path
+
+    def tmp_path(self, name):
+        d = self._dir(name)
+        os.makedirs(d, exist_ok=True)
+        return d + name + ".%08x" % random.randrange(2**64)
+
+    def commit(self, name, tmp):
+        path = self._dir(name) + name
+        os.rename(tmp, path)
+        return os.stat(path).st_mtime
+
+    def touch(self, names):
+        # Record accesses in st_atime, leaving st_mtime (the entry age) alone
+        now = time.time()
+        for name in names:
+            try:
+                path = self.path(name)
+                os.utime(path, (now, os.stat(path).st_mtime))
+            except FileNotFoundError:
+                pass
+
+    def parts(self):
+        if not self.shard:
+            return [None]
+        # The root itself holds unmigrated flat files
+        return [None] + ["%02x" % i for i in range(256)]
+
+    def scan(self, part=None):
+        # Yields (name, size, mtime, atime), temporary files included
+        if part is None:
+            dirs = [self.root]
+        else:
+            dirs = [dp for dp, dn, fn in os.walk(self.root + part)]
+        for d in dirs:
+            try:
+                it = os.scandir(d)
+            except FileNotFoundError:
+                continue
+            with it:
+                for entry in it:
+                    if entry.name.startswith(".") or not entry.is_file():
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield entry.name, st.st_size, st.st_mtime, st.st_atime
+
+    def delete(self, name):
+        # Temporary files sit in the same directory as the entry they replace,
+        # and unmigrated entries in the root
+        base = name.rsplit(".", 1)[0] if is_tmp(name) else name
+        for path in (self._dir(base) + name, self.root + name):
+            try:
+                os.unlink(path)
+                return True
+            except FileNotFoundError:
+                pass
+        return False
+
+class SqliteStorage(Storage):
+    """Single-file key-value store for small entries (profile info, snapshots)."""
+
+    def __init__(self, name, path, legacy_dir=None):
+        Storage.__init__(self, name, legacy_dir)
+        self.path = path
+        self.local = threading.local()
+        db = self._db()
+        with db:
+            db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            db.execute("CREATE TABLE IF NOT EXISTS entries "
+                       "(name TEXT PRIMARY KEY, mtime REAL, data BLOB, atime REAL)")
+            columns = [row[1] for row in db.execute("PRAGMA table_info(entries)")]
+            if "atime" not in columns:
+                db.execute("ALTER TABLE entries ADD COLUMN atime REAL")
+        # With preload_app this runs in the master; workers open their own
+        db.close()
+        self.local.db = None
+
+    def _db(self):
+        # sqlite3 connections cannot be shared across threads or fork()
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def _mtime(self, name):
+        row = self._db().execute("SELECT mtime FROM entries WHERE name = ?",
+                                 (name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _load(self, name):
+        row = self._db().execute("SELECT data, mtime FROM entries WHERE name = ?",
+                                 (name,)).fetchone()
+        if row is None:
+            raise FileNotFoundError(errno.ENOENT, "Not in %s store" % self.name, name)
+        return bytes(row[0]), row[1]
+
+    def tmp_path(self, name):
+        return self.path + ".%08x" % random.randrange(2**64)
+
+    def commit(self, name, tmp):
+        with open(tmp, "rb") as fd:
+            data = fd.read()
+            mtime = os.fstat(fd.fileno()).st_mtime
+        with self._db() as db:
+            db.execute("INSERT OR REPLACE INTO entries (name, mtime, data, atime) "
+                       "VALUES (?, ?, ?, ?)", (name, mtime, data, mtime))
+        os.unlink(tmp)
+        return mtime
+
+    def touch(self, names):
+        now = time.time()
+        with self._db() as db:
+            db.executemany("UPDATE entries SET atime = ? WHERE name = ?",
+                           ((now, name) for name in names))
+
+    def scan(self, part=None):
+        rows = self._db().execute("SELECT name, length(data), mtime, "
+                                  "coalesce(atime, mtime) FROM entries").fetchall()
+        for row in rows:
+            yield row
+        # Temporary files from interrupted commits live next to the database
+        d, base = os.path.split(self.path)
+        with os.scandir(d or ".") as it:
+            for entry in it:
+                if entry.name.startswith(base + ".") and is_tmp(entry.name):
+                    st = entry.stat()
+                    yield entry.name, st.st_size, st.st_mtime, st.st_atime
+
+    def delete(self, name):
+        if is_tmp(name):
+            try:
+                os.unlink(os.path.join(os.path.dirname(self.path), name))
+                return True
+            except FileNotFoundError:
+                return False
+        with self._db() as db:
+            return db.execute("DELETE FROM entries WHERE name = ?", (name,)).rowcount > 0
+
+    def compact(self):
+        with self._db() as db:
+            db.execute("PRAGMA incremental_vacuum")
+
+def open_storage(spec, name=None, legacy_dir=None):
+    # "flat:<dir>", "sharded:<dir>" or "sqlite:<file>"
+    kind, path = spec.split(":", 1)
+    if name is None:
+        name = os.path.basename(path.rstrip("/")).split(".")[0]
+    if kind == "flat":
+        return FileStorage(name, path, shard=0, legacy_dir=legacy_dir)
+    elif kind == "sharded":
+        return FileStorage(name, path, legacy_dir=legacy_dir)
+    elif kind == "sqlite":
+        return SqliteStorage(name, path, legacy_dir=legacy_dir)
+    raise ValueError("Unknown storage type %r" % kind)
+
+def migrate(src_dir, dest, remove=False):
+    count = 0
+    for entry in os.scandir(src_dir):
+        # Skip subdirectories (shards), temporary files and placeholders
+        if not entry.is_file() or entry.name.startswith(".") or is_tmp(entry.name):
+            continue
+        if isinstance(dest, FileStorage):
+            path = dest._dir(entry.name) + entry.name
+            if path == entry.path:
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if remove:
+                os.rename(entry.path, path)
+            else:
+                os.link(entry.path, path)
+        else:
+            with open(entry.path, "rb") as fd:
+                dest.put(entry.name, fd.read(), entry.stat().st_mtime)
+            if remove:
+                os.unlink(entry.path)
+        count += 1
+        if count % 10000 == 0:
+            print("%s: %d entries migrated" % (src_dir, count))
+    print("%s: %d entries migrated" % (src_dir, count))
+
+if __name__ == "__main__":
+    # Usage: storage.py <flat source dir> <dest spec> [--remove]
+    # e.g. storage.py data/info/ sqlite:data/info.db --remove
+    migrate(sys.argv[1], open_storage(sys.argv[2]), remove="--remove" in sys.argv[3:])
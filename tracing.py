@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections, contextlib, functools, threading, time
+
+# Per-thread trace of the request being handled. Spans outside of a trace
+# (background refreshes, CLI tools) cost next to nothing and are dropped.
+_local = threading.local()
+
+def begin():
+    _local.start = time.perf_counter()
+    _local.spans = collections.OrderedDict()
+
+def end():
+    spans = getattr(_local, "spans", None)
+    if spans is not None:
+        spans["total"] = (time.perf_counter() - _local.start, 1)
+    _local.spans = None
+    return spans
+
+@contextlib.contextmanager
+def span(name):
+    spans = getattr(_local, "spans", None)
+    if spans is None:
+        yield
+        return
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        total, count = spans.get(name, (0, 0))
+        spans[name] = (total + time.perf_counter() - t, count + 1)
+
+def traced(name):
+    def wrap(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return wrap
+
+def server_timing(spans):
+    # Repeated spans are summed, with the count in the description
+    out = []
+    for name, (total, count) in spans.items():
+        if count > 1:
+            out.append('%s;desc="x%d";dur=%.1f' % (name, count, total * 1000))
+        else:
+            out.append('%s;dur=%.1f' % (name, total * 1000))
+    return ", ".join(out)
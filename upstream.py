@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -!- coding: utf-8 -!-
+#
+# Copyright 2016 Hector Martin <marcan@marcan.st>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading, time
+
+class CircuitOpen(Exception):
+    pass
+
+class UpstreamController(object):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    # Result codes that mean the game server is down for maintenance
+    MAINTENANCE_CODES = (101,)
+
+    def __init__(self, logger, delay=2, min_delay=2, max_delay=30,
+                 recovery=0.9, backoff=2.0, max_spike=4.0, slow_latency=3.0,
+                 max_errors=3, cooldown=60):
+        self.logger = logger
+        self.delay = delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.recovery = recovery
+        self.backoff = backoff
+        self.max_spike = max_spike
+        self.slow_latency = slow_latency
+        self.max_errors = max_errors
+        self.cooldown = cooldown
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.opened_at = 0
+        self.probing = False
+        self.errors = 0
+        self.latency = None
+        self.error_rate = 0.0
+        # Delay before the current run of slow replies, if in one
+        self.spike_base = None
+
+    def check(self):
+        with self.lock:
+            if self.state == self.OPEN and time.time() - self.opened_at < self.cooldown:
+                raise CircuitOpen()
+            if self.state == self.HALF_OPEN and self.probing:
+                raise CircuitOpen()
+
+    def _acquire(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.cooldown:
+                    raise CircuitOpen()
+                self.logger.info("Upstream circuit half-open, probing")
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.HALF_OPEN:
+                if self.probing:
+                    raise CircuitOpen()
+                self.probing = True
+
+    def _open(self, why):
+        self.logger.warning("Upstream circuit open (%s), cooling down for %d sec",
+                            why, self.cooldown)
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.probing = False
+
+    def _slow_down(self):
+        # One spike can only raise the delay by max_spike, however long it lasts
+        if self.spike_base is None:
+            self.spike_base = self.delay
+        limit = min(self.max_delay, self.spike_base * self.max_spike)
+        self.delay = max(self.delay, min(limit, self.delay * self.backoff))
+
+    def _record(self, latency, code=None, error=False):
+        with self.lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.error_rate = 0.9 * self.error_rate + (0.1 if error else 0)
+
+            if error:
+                self.errors += 1
+                self._slow_down()
+                if self.state == self.HALF_OPEN or self.errors >= self.max_errors:
+                    self._open("%d consecutive errors" % self.errors)
+                return
+
+            self.errors = 0
+            if code in self.MAINTENANCE_CODES:
+                self._open("result code %d" % code)
+                return
+
+            if self.state != self.CLOSED:
+                self.logger.info("Upstream circuit closed")
+                self.state = self.CLOSED
+                self.probing = False
+
+            # Back off as soon as a reply is slow (or errors pile up), and
+            # recover proportionally once they are fast again: the averages
+            # lag behind, so they do not decide on their own
+            if latency > self.slow_latency or self.error_rate > 0.1:
+                self._slow_down()
+            else:
+                self.spike_base = None
+                self.delay = max(self.min_delay, self.delay * self.recovery)
+
+    def call(self, func, *args):
+        self._acquire()
+        start = time.time()
+        try:
+            reply = func(*args)
+        except Exception:
+            self._record(time.time() - start, error=True)
+            raise
+        self._record(time.time() - start, reply["data_headers"]["result_code"])
+        return reply